@@ -0,0 +1,111 @@
+"""Benchmark the memory and set operations of Track on synthetic libraries.
+
+Run with "memory", "sets" or no argument for both. Only the Track constructor is used, so the
+script also runs on earlier revisions for comparison.
+"""
+import gc
+import json
+import random
+import sys
+import time
+import tracemalloc
+from collections import OrderedDict
+from typing import Callable, List
+
+from utility import Track
+
+MEMORY_TRACKS = 100000  # Size of the library whose memory is measured
+MARKETS = 180  # Markets of each track, as most tracks are available in about this many
+SET_TRACKS = 20000  # Size of the playlists combined by the set operations
+SET_OTHER_NEW = 5000  # Tracks of the other playlist which are not in the first
+SET_ROUNDS = 5  # Runs of each set operation to average
+SEED = 1
+
+WORDS = ["love", "night", "day", "heart", "fire", "blue", "song", "road", "time", "light"]
+
+
+def phrase(rng: random.Random, words: int) -> str:
+    """Get a random title of the given number of words."""
+    return " ".join(
+        rng.choice(WORDS) + str(rng.randrange(1000)) for _ in range(words)
+    ).title()
+
+
+def track_fields(rng: random.Random, count: int, markets=None) -> List[dict]:
+    """Get the fields of count tracks by 2000 artists, as read from the Spotify API."""
+    artists = [phrase(rng, 2) for _ in range(2000)]
+    albums = [phrase(rng, 3) for _ in range(count // 10 + 1)]
+    return [
+        dict(
+            name=phrase(rng, rng.randint(1, 4)),
+            artist=rng.choice(artists),
+            album=rng.choice(albums),
+            is_local=False,
+            id=f"{i:022d}",
+            duration_ms=200000,
+            available_markets=markets,
+            is_playable=None,
+        )
+        for i in range(count)
+    ]
+
+
+def bench_memory():
+    """Measure the memory retained by a library of MEMORY_TRACKS tracks decoded from json."""
+    rng = random.Random(SEED)
+    markets = [f"{a}{b}" for a in "ABCDEFGHIJKLMNO" for b in "ABCDEFGHIJKL"][:MARKETS]
+    # Decode from json so every track has its own strings and market list, as when loaded
+    fields = json.loads(json.dumps(track_fields(rng, MEMORY_TRACKS, markets)))
+    gc.collect()
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    tracks = [Track(**track) for track in fields]
+    seconds = time.perf_counter() - start
+    del fields
+    gc.collect()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(
+        f"{len(tracks)} tracks: {retained / 2 ** 20:.1f} MiB retained, "
+        f"{peak / 2 ** 20:.1f} MiB peak, built in {seconds:.2f}s"
+    )
+
+
+def bench_sets():
+    """Time the set operations of playlists on SET_TRACKS tracks."""
+    rng = random.Random(SEED)
+    fields = track_fields(rng, SET_TRACKS + SET_OTHER_NEW)
+    own = [Track(**track) for track in fields[:SET_TRACKS]]
+    other = own[SET_OTHER_NEW:] + [Track(**track) for track in fields[SET_TRACKS:]]
+    rng.shuffle(other)
+    copies = [Track(**track) for track in fields[:SET_TRACKS]]  # Equal but distinct
+    other_set = set(other)
+
+    def run(name: str, operation: Callable[[], object]):
+        """Print the average time of an operation."""
+        start = time.perf_counter()
+        for _ in range(SET_ROUNDS):
+            operation()
+        milliseconds = (time.perf_counter() - start) / SET_ROUNDS * 1000
+        print(f"{name:<30} {milliseconds:>7.1f} ms")
+
+    print(f"{SET_TRACKS} tracks against {len(other)}:")
+    run("OrderedDict.fromkeys dedupe", lambda: list(OrderedDict.fromkeys(own + other)))
+    run("set intersection", lambda: set(own) & set(other))
+    run("set difference", lambda: set(own) - set(other))
+    run("element-wise list ==", lambda: own == copies)
+    run("membership against a set", lambda: [t for t in own if t in other_set])
+
+
+BENCHMARKS = {"memory": bench_memory, "sets": bench_sets}
+
+
+def main(argv):
+    """Run the benchmarks named in argv, or every benchmark."""
+    for name in argv or BENCHMARKS:
+        BENCHMARKS[name]()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
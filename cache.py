@@ -0,0 +1,135 @@
+"""Persist Spotify results between runs."""
+import atexit
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterable, List, Optional
+
+from utility import Track
+
+CACHE_DIR = "cache"
+
+
+def cache_path(*parts: str) -> str:
+    """Get the path of a cache file from its name parts."""
+    return os.path.join(CACHE_DIR, *parts) + ".json"
+
+
+def load_json(*parts: str, default=None):
+    """Load a cache file or return default if it is missing or unreadable."""
+    try:
+        with open(cache_path(*parts), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def save_json(data, *parts: str):
+    """Save a cache file, replacing any previous version at once."""
+    path = cache_path(*parts)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(path + ".tmp", path)
+
+
+def remove_json(*parts: str):
+    """Remove a cache file if it exists."""
+    try:
+        os.remove(cache_path(*parts))
+    except FileNotFoundError:
+        pass
+
+
+def dump_tracks(tracks: Iterable[Track]) -> dict:
+    """Convert tracks to json data. Market lists are stored once and referenced by index."""
+    markets = {}
+    dicts = []
+    for track in tracks:
+        fields = track.as_dict()
+        if fields["available_markets"]:
+            fields["available_markets"] = markets.setdefault(
+                fields["available_markets"], len(markets)
+            )
+        dicts.append(fields)
+    return {"markets": list(markets), "tracks": dicts}
+
+
+def load_tracks(data: dict) -> List[Track]:
+    """Convert json data from dump_tracks to tracks."""
+    markets = data["markets"]
+    tracks = []
+    for fields in data["tracks"]:
+        fields = dict(fields)
+        if isinstance(fields["available_markets"], int):
+            fields["available_markets"] = markets[fields["available_markets"]]
+        tracks.append(Track(**fields))
+    return tracks
+
+
+class DiskCache:
+    """Maintain json values on disk which expire after a time to live.
+
+    Empty (negative) results may expire sooner. The least recently used entries are evicted beyond
+    max_entries. Changes are saved on save() and at exit. Reads only reorder entries, so they are
+    saved with the next change rather than rewriting the file by themselves.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        ttl: float,
+        negative_ttl: Optional[float] = None,
+        max_entries: Optional[int] = None,
+    ):
+        self.name = name
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self.max_entries = max_entries
+        entries = load_json(name, default={})
+        # Least recently used first. Older files kept the time each entry was used instead
+        self.entries = OrderedDict(
+            sorted(entries.items(), key=lambda item: item[1].pop("used", 0))
+        )
+        self.changed = False
+        self.lock = threading.Lock()
+        atexit.register(self.save)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key: str):
+        return self.get(key) is not None
+
+    def get(self, key: str):
+        """Get the value for key or None if it is missing or expired."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            ttl = self.negative_ttl if entry["negative"] else self.ttl
+            if time.time() - entry["time"] > ttl:
+                del self.entries[key]
+                self.changed = True
+                return None
+            self.entries.move_to_end(key)
+            return entry["value"]
+
+    def set(self, key: str, value, negative: bool = False):
+        """Store value for key. Negative values expire after negative_ttl."""
+        with self.lock:
+            self.entries[key] = {"value": value, "negative": negative, "time": time.time()}
+            self.entries.move_to_end(key)
+            if self.max_entries is not None:
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+            self.changed = True
+
+    def save(self):
+        """Save the entries if they changed."""
+        with self.lock:
+            if self.changed:
+                save_json(self.entries, self.name)
+                self.changed = False
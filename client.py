@@ -0,0 +1,135 @@
+"""Share one rate limited, pooled Spotify client between every request."""
+import threading
+import time
+
+import requests
+import spotipy
+from requests.adapters import HTTPAdapter
+from spotipy.exceptions import SpotifyException
+from urllib3 import Retry
+
+try:
+    import orjson
+except ImportError:  # Responses are decoded by requests instead
+    orjson = None
+
+REQUESTS_PER_SECOND = 10  # Sustained request rate shared by every client
+REQUESTS_BURST = 20  # Requests which may be sent at once after a quiet period
+RATE_LIMIT_RETRIES = 5  # Attempts after a 429 response before giving up
+DEFAULT_RETRY_AFTER = 5  # Seconds to wait after a 429 response without a Retry-After header
+POOL_SIZE = 16  # Keep-alive connections per host
+TOKEN_MARGIN = 60  # Seconds before expiry at which a token is refreshed
+RETRY_STATUSES = (500, 502, 503, 504)  # 429 is handled by the rate limiter instead
+
+
+class RateLimiter:
+    """Maintain a token bucket which spaces out requests and pauses everyone after a 429."""
+
+    def __init__(self, rate: float = REQUESTS_PER_SECOND, burst: int = REQUESTS_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a request may be sent."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now >= self.paused_until:
+                    self.tokens = min(
+                        self.burst, self.tokens + (now - self.updated) * self.rate
+                    )
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    wait = self.paused_until - now
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        """Stop all requests for the given number of seconds."""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.updated = self.paused_until
+            self.tokens = 0.0
+
+
+LIMITER = RateLimiter()
+
+
+def build_session() -> requests.Session:
+    """Create a keep-alive session which retries server errors.
+
+    429 responses are left to SharedSpotify so the shared limiter pauses every thread. Server
+    errors which outlast the retries are returned with their own status, as spotipy would
+    otherwise report them as a 429.
+    """
+    session = requests.Session()
+    retry = Retry(
+        total=3,
+        connect=None,
+        read=False,
+        status=3,
+        backoff_factor=0.3,
+        status_forcelist=RETRY_STATUSES,
+        respect_retry_after_header=False,  # Leave 429s to the shared limiter
+        raise_on_status=False,  # Return the last server error rather than a RetryError
+    )
+    adapter = HTTPAdapter(
+        pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=retry
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    if orjson is not None:
+        session.hooks["response"].append(fast_json)
+    return session
+
+
+def fast_json(response: requests.Response, *args, **kwargs) -> requests.Response:
+    """Decode the json of a response with orjson."""
+    # orjson errors are ValueErrors, which spotipy expects for empty bodies
+    response.json = lambda **_: orjson.loads(response.content)
+    return response
+
+
+class SharedSpotify(spotipy.Spotify):
+    """Maintain a Spotify client which refreshes its token on expiry and obeys the rate limiter."""
+
+    def __init__(self, auth_manager, limiter: RateLimiter = LIMITER, **kwargs):
+        super().__init__(
+            auth_manager=auth_manager, requests_session=build_session(), **kwargs
+        )
+        self.limiter = limiter
+        self.token_info = None
+        self.token_lock = threading.Lock()
+
+    def _auth_headers(self):
+        with self.token_lock:
+            if (
+                self.token_info is None
+                or self.token_info["expires_at"] - time.time() < TOKEN_MARGIN
+            ):
+                # Refreshes the token if it is expiring
+                self.token_info = self.auth_manager.get_cached_token()
+        return {"Authorization": f"Bearer {self.token_info['access_token']}"}
+
+    def _internal_call(self, method, url, payload, params):
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            self.limiter.acquire()
+            try:
+                return super()._internal_call(method, url, payload, dict(params))
+            except SpotifyException as e:
+                if not is_rate_limit(e) or attempt == RATE_LIMIT_RETRIES:
+                    raise
+                retry_after = e.headers.get("Retry-After", DEFAULT_RETRY_AFTER)
+                self.limiter.pause(float(retry_after) + attempt)
+
+
+def is_rate_limit(error: SpotifyException) -> bool:
+    """Determine whether an error is a 429 response, not spotipy's 429 for exhausted retries."""
+    return error.http_status == 429 and bool(error.headers)
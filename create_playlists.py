@@ -1,13 +1,18 @@
 """Create default playlists."""
 import calendar
 import re
+import sys
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from functools import partial
+from itertools import chain
 from typing import Optional
 
-import pylast
 from tqdm import tqdm
 
+import playlists
+from cache import load_json, save_json
 from playlists import (
     get_credentials,
     get_spotify,
@@ -16,29 +21,24 @@ from playlists import (
     search,
     get_playlists,
     get_playlist_tracks,
+    get_catalog,
 )
 
 # warnings.simplefilter("ignore")
-from utility import find_match, Track
+from jobs import Job, run_jobs
+from lastfm import get_lastfm, get_top_tracks, library_fingerprint, ResolutionTable
+from utility import find_match
 
 GRAHAM_PLAYLISTS = ("12disdWwNkqwvpbzjDRLia", "6xUAxUPG83IhQgrHL9t7Zp", "2V5F1ru0WYjstMDttoDjoi")
+FAT_PLAYLIST = "1WN0DhY37vI954VYCuopVl"
+REECE_JACOB_PLAYLIST = "2L9XOIqXKBA6hZETQouQay"
+JACOB_PLAYLIST = "4KNOgPEWJhefIXpUGOOSMU"
 
 print = tqdm.write
 
-creds = get_credentials()
-spotify = get_spotify(creds["spotify"])
+# Jobs run when none are given on the command line
+DEFAULT_JOBS = ("monthly", "current_rotation", "smart", "graham")
 
-saved_songs = get_saved_songs(spotify)
-p_saved_songs = Playlist(spotify, "Liked Songs")
-p_saved_songs += saved_songs
-
-p_current_rotation = Playlist(spotify, "Current Rotation", populate=True)
-p_lastfm_top = Playlist(spotify, "Lastfm Top", populate=True)
-p_instrumental = Playlist(spotify, "All Instrumental", populate=True)
-p_all_monthly = Playlist(spotify, "All Monthly", populate=True)
-p_all_monthly.allow_duplicates = True
-
-today = datetime.today()
 # number of months before today to include in monthly_playlist
 MONTHLY_BACK_MONTHS: Optional[int] = None
 
@@ -48,37 +48,34 @@ if MONTHLY_BACK_MONTHS:
     cutoff_date = cutoff_date.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
 
 
-def create_smart_playlists():
+def create_smart_playlists(spotify, saved_songs, local, instrumental):
     """Create the liked songs playlists."""
-    global spotify
-    p_local = Playlist(spotify, "Local Files", populate=True)
-
-    p_all_saved = p_saved_songs + p_local
+    p_all_saved = saved_songs + local
     p_all_saved.name = "All Saved"
 
     p_saved_bands = Playlist(spotify, "Liked Songs - Bands")
-    p_saved_bands += p_all_saved - p_instrumental
+    p_saved_bands += p_all_saved - instrumental
     p_saved_bands.publish()
-    spotify = get_spotify(creds["spotify"])  # To make sure we don't expire
 
     p_saved_instrumentals = Playlist(spotify, "Liked Songs - Instrumentals")
-    p_saved_instrumentals += p_instrumental & p_all_saved
+    p_saved_instrumentals += instrumental & p_all_saved
     p_saved_instrumentals.publish()
-    spotify = get_spotify(creds["spotify"])  # To make sure we don't expire
 
     p_save_songs_all = Playlist(spotify, "Liked Songs - All")
     p_save_songs_all += p_saved_instrumentals + p_saved_bands
     p_save_songs_all.publish()
-    spotify = get_spotify(creds["spotify"])  # To make sure we don't expire
+
+    return {"saved_bands": p_saved_bands}
 
 
-def create_graham_playlists():
+def create_graham_playlists(spotify, current_rotation, saved_bands):
     """Create the current rotation and liked bands with Graham's tracks included."""
     p_rotation_graham = Playlist(spotify, "Current Rotation with Graham")
     p_bands_graham = Playlist(spotify, "Liked Songs - Bands with Graham")
-    p_rotation_graham += p_current_rotation
-    p_bands_graham += Playlist(spotify, "Liked Songs - Bands", populate=True)
+    p_rotation_graham += current_rotation
+    p_bands_graham += saved_bands
 
+    get_catalog(spotify).resolve(spotify, GRAHAM_PLAYLISTS)
     for playlist_id in GRAHAM_PLAYLISTS:
         playlist = Playlist(spotify, None, id_=playlist_id, populate=True)
         p_rotation_graham += playlist
@@ -87,101 +84,89 @@ def create_graham_playlists():
     p_bands_graham.publish()
 
 
-def get_lastfm(l_creds):
-    """Get the lastfm network object from which to make requests."""
-    lastfm_password = l_creds["password"]
-    lastfm_pass_hash = pylast.md5(lastfm_password)
-    return pylast.LastFMNetwork(
-        api_key=l_creds["api_key"],
-        api_secret=l_creds["api_secret"],
-        username=l_creds["username"],
-        password_hash=lastfm_pass_hash,
-    )
-
-
-def update_lastfm_playlist():
+def update_lastfm_playlist(spotify, l_creds, lastfm_top, saved_songs, instrumental):
     """Get top tracks from last.fm data."""
-    global p_lastfm_top
+    search_lists = {
+        "p_lastfm_top": lastfm_top,
+        "saved_songs": saved_songs,
+    }
 
-    lastfm_network = get_lastfm(creds["last.fm"])
+    lastfm_network = get_lastfm(l_creds)
     lastfm_user = lastfm_network.get_authenticated_user()
-    lastfm_top_tracks = []
-    # Available periods as per last.fm docs (NOT PYLAST DOCS): overall | 7day | 1month | 3month | 6month | 12month
-    # Using pylast period format (PERIOD_OVERALL | PERIOD_7DAYS | PERIOD_1MONTH | etc) just returns results for overall
-    for num, period in (
-        (150, "overall"),
-        (100, "3month"),
-        (30, "1month"),
-        (10, "7day"),
-    ):
-        lastfm_top_tracks += lastfm_user.get_top_tracks(limit=num, period=period)
+    lastfm_top_tracks = get_top_tracks(lastfm_user)
 
-    tracks = []
-    missing = []
-    searched_tracks = []
-    for result in tqdm(
-        lastfm_top_tracks, "Finding lastfm songs on Spotify", leave=False,
-    ):
-        name = result.item.get_name()
-        album = None
-        artist = None
-        try:
-            album = result.item.get_album().get_name()
-        except AttributeError:
-            pass
-            # warnings.warn(f"No album associated with {name}")
-        try:
-            artist = result.item.get_artist().get_name()
-        except AttributeError:
-            warnings.warn(f"No artist associated with {name}")
-
-        # Search current_rotation and saved_songs
-        target = Track(name=name, album=album, artist=artist)
-        if target in searched_tracks:
-            continue
-        searched_tracks.append(target)
-
-        found = False
+    def match_library(target):
+        """Get the best match for target in the previous Lastfm Top or saved songs."""
         for group in search_lists:
             best_result = find_match(search_lists[group], target, group)
             if best_result:
-                tracks.append(best_result)
-                found = True
-                break
-        if found:
-            continue
-
-        warnings.warn(f"Could not find match for {target} in user library")
-
-        # Try spotify search
+                return best_result
+        return None
+
+    # The previous Lastfm Top only holds earlier resolutions, so only saved songs count as changes
+    resolutions = ResolutionTable()
+    revalidated = resolutions.revalidate(
+        library_fingerprint(saved_songs),
+        lastfm_top_tracks,
+        match_library,
+        set(chain(lastfm_top, saved_songs)),
+    )
 
-        best_result = search(spotify, name, album, artist)
+    tracks = []
+    missing = []
+    reused = 0
+    for target in tqdm(
+        lastfm_top_tracks, "Finding lastfm songs on Spotify", leave=False,
+    ):
+        resolved, best_result = resolutions.get(target)
+        if resolved:
+            reused += 1
+        else:
+            # Search current_rotation and saved_songs
+            best_result = match_library(target)
+            source = "library"
+            if not best_result:
+                warnings.warn(f"Could not find match for {target} in user library")
+
+                # Try spotify search
+                best_result = search(
+                    spotify, target.name, target.album, target.artist, parallel=True
+                )
+                source = "search"
+                if not best_result:
+                    warnings.warn(
+                        f"Could not find any spotify match for {(target.name, target.album, target.artist)}"
+                    )
+            resolutions.set(target, best_result, source)
 
         if best_result:
             tracks.append(best_result)
-            continue
         else:
-            warnings.warn(
-                f"Could not find any spotify match for {(name, album, artist)}"
-            )
             missing.append(target)
+    resolutions.save()
+    print(
+        f"Lastfm Top: {reused} of {len(lastfm_top_tracks)} tracks resolved from the table, "
+        f"{revalidated} revalidated."
+    )
 
     if missing:
         print("\n**Could not find matches for " + ", ".join(repr(t) for t in missing))
 
-    p_lastfm_top.tracks.clear()
+    p_lastfm_top = Playlist(spotify, lastfm_top.name, lastfm_top.id)
     p_lastfm_top += tracks
-    p_lastfm_top -= p_instrumental
+    p_lastfm_top -= instrumental
 
     p_lastfm_top.publish()
 
-    return tracks, missing
+    return {"lastfm_top": p_lastfm_top}
 
 
-def update_all_monthly_playlist():
-    """Compile all monthly playlists into one."""
-    global p_all_monthly
+def update_all_monthly_playlist(spotify):
+    """Compile all monthly playlists into one.
 
+    Publishing is skipped when no monthly playlist changed since the last compile. Otherwise the
+    publish plan only touches the changed months.
+    """
     months = tuple(month.lower() for month in calendar.month_name)[1:]
     months_str = "|".join(months)
     month_match = re.compile(f"({months_str})(-({months_str}))" + "? [0-9]{4}")
@@ -204,33 +189,66 @@ def update_all_monthly_playlist():
             if cutoff_date is None or date >= cutoff_date:
                 monthly_playlist_ids.append((date, playlist_id["id"]))
 
-    p_all_monthly.tracks.clear()
-    for playlist in sorted(monthly_playlist_ids, key=lambda p: p[0], reverse=True):
-        p_all_monthly += get_playlist_tracks(spotify, playlist[1])
+    # Months are fetched at once. Unchanged months are read from the snapshot cache
+    monthly_playlist_ids = [
+        playlist_id
+        for _, playlist_id in sorted(monthly_playlist_ids, key=lambda p: p[0], reverse=True)
+    ]
+    catalog = get_catalog(spotify)
+    segments = [
+        [playlist_id, catalog.find(playlist_id)["snapshot_id"]]
+        for playlist_id in monthly_playlist_ids
+    ]
+    with ThreadPoolExecutor(max_workers=playlists.PAGE_WORKERS) as executor:
+        month_tracks = list(
+            executor.map(
+                lambda playlist_id: get_playlist_tracks(spotify, playlist_id),
+                monthly_playlist_ids,
+            )
+        )
+
+    p_all_monthly = Playlist(spotify, "All Monthly", allow_duplicates=True)
+    p_all_monthly += list(chain.from_iterable(month_tracks))
+
+    # Skip publishing if no month changed and All Monthly is as the last compile left it
+    compiled = load_json("monthly", default={})
+    changed = [segment for segment in segments if segment not in compiled.get("segments", [])]
+    online = catalog.find(p_all_monthly.id) if p_all_monthly.id else None
+    if (
+        compiled.get("segments") == segments
+        and online is not None
+        and online["snapshot_id"] is not None
+        and compiled.get("snapshot_id") == online["snapshot_id"]
+    ):
+        print(f"All Monthly unchanged, {len(segments)} months up to date.")
+        return {"all_monthly": p_all_monthly}
 
-    p_all_monthly.publish()
+    print(f"All Monthly: {len(changed)} of {len(segments)} months changed.")
+    plan = p_all_monthly.publish()
+    if not playlists.DRY_RUN:
+        # The listed snapshot is only current if the publish made no changes
+        online = catalog.find(p_all_monthly.id)
+        snapshot_id = online["snapshot_id"] if not plan.operations else None
+        save_json({"segments": segments, "snapshot_id": snapshot_id}, "monthly")
 
-    return p_all_monthly
+    return {"all_monthly": p_all_monthly}
 
 
-def create_current_rotation(update_lastfm=False, update_monthly=False):
+def create_current_rotation(spotify, all_monthly, lastfm_top, instrumental):
     """Create the current rotation playlist."""
-    global p_current_rotation
-    if update_lastfm:
-        update_lastfm_playlist()
-    if update_monthly:
-        update_all_monthly_playlist()
-
-    p_fat = Playlist(spotify, None, id_="1WN0DhY37vI954VYCuopVl", populate=True)
-    p_reece_jacob = Playlist(spotify, None, id_="2L9XOIqXKBA6hZETQouQay", populate=False)
-    p_jacob = Playlist(spotify, None, id_="4KNOgPEWJhefIXpUGOOSMU", populate=True)
-
-    p_current_rotation.tracks.clear()
-    p_current_rotation += p_all_monthly
-    p_current_rotation += p_lastfm_top
+    get_catalog(spotify).resolve(
+        spotify, (FAT_PLAYLIST, REECE_JACOB_PLAYLIST, JACOB_PLAYLIST)
+    )
+    p_fat = Playlist(spotify, None, id_=FAT_PLAYLIST, populate=True)
+    p_reece_jacob = Playlist(spotify, None, id_=REECE_JACOB_PLAYLIST, populate=False)
+    p_jacob = Playlist(spotify, None, id_=JACOB_PLAYLIST, populate=True)
+
+    p_current_rotation = Playlist(spotify, "Current Rotation")
+    p_current_rotation += all_monthly
+    p_current_rotation += lastfm_top
     p_current_rotation += p_fat
 
-    p_current_rotation -= p_instrumental
+    p_current_rotation -= instrumental
 
     p_current_rotation.publish()
 
@@ -238,14 +256,80 @@ def create_current_rotation(update_lastfm=False, update_monthly=False):
     p_reece_jacob += p_jacob
     p_reece_jacob.publish()
 
+    return {"current_rotation": p_current_rotation}
+
+
+def load_saved_songs(spotify):
+    """Load the users saved songs into a playlist."""
+    p_saved_songs = Playlist(spotify, "Liked Songs")
+    p_saved_songs += get_saved_songs(spotify)
+    return p_saved_songs
+
+
+def main(argv):
+    """Run the jobs named in argv, or DEFAULT_JOBS, and report their timings.
+
+    Options: --dry-run plans and reports API calls without writing, --lazy evaluates playlist
+    operators once tracks are needed.
+    """
+    playlists.DRY_RUN = "--dry-run" in argv
+    playlists.LAZY = "--lazy" in argv
+    selected = [arg for arg in argv if not arg.startswith("--")] or DEFAULT_JOBS
+
+    creds = get_credentials()
+    # Dry runs read from the cache, so no client is built and no token refreshed
+    spotify = None if playlists.DRY_RUN else get_spotify(creds["spotify"])
+    get_catalog(spotify)  # Load the playlist list once before jobs run concurrently
+
+    def load(name):
+        """Get a loader of the playlist with the given name."""
+        return lambda: Playlist(spotify, name, populate=True)
+
+    loaders = {
+        "saved_songs": partial(load_saved_songs, spotify),
+        "local": load("Local Files"),
+        "instrumental": load("All Instrumental"),
+        "all_monthly": load("All Monthly"),
+        "lastfm_top": load("Lastfm Top"),
+        "current_rotation": load("Current Rotation"),
+        "saved_bands": load("Liked Songs - Bands"),
+    }
+    jobs = (
+        Job(
+            "lastfm",
+            partial(update_lastfm_playlist, spotify, creds["last.fm"]),
+            inputs=("lastfm_top", "saved_songs", "instrumental"),
+            outputs=("lastfm_top",),
+        ),
+        Job(
+            "monthly",
+            partial(update_all_monthly_playlist, spotify),
+            outputs=("all_monthly",),
+        ),
+        Job(
+            "current_rotation",
+            partial(create_current_rotation, spotify),
+            inputs=("all_monthly", "lastfm_top", "instrumental"),
+            outputs=("current_rotation",),
+        ),
+        Job(
+            "smart",
+            partial(create_smart_playlists, spotify),
+            inputs=("saved_songs", "local", "instrumental"),
+            outputs=("saved_bands",),
+        ),
+        Job(
+            "graham",
+            partial(create_graham_playlists, spotify),
+            inputs=("current_rotation", "saved_bands"),
+        ),
+    )
+    _, report = run_jobs(jobs, loaders, selected)
+
+    print(str(report))
+    if playlists.DRY_RUN:
+        print(f"Planned API calls: {dict(playlists.PLANNED_CALLS)}")
 
-search_lists = {
-    "p_lastfm_top": p_lastfm_top,
-    "saved_songs": p_saved_songs,
-}
 
-update_all_monthly_playlist()
-# update_lastfm_playlist()
-create_current_rotation()
-create_smart_playlists()
-create_graham_playlists()
+if __name__ == "__main__":
+    main(sys.argv[1:])
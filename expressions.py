@@ -0,0 +1,159 @@
+"""Evaluate lazy playlist operations as a graph of shared expressions."""
+import weakref
+from typing import Callable, Iterable, OrderedDict, Sequence
+
+OPERATIONS = ("add", "sub", "and")
+
+
+class Expression:
+    """Maintain a node of a playlist expression graph.
+
+    Nodes are shared: building the same operation on the same operands twice gives the same node.
+    refs counts the operations and playlists which use a node. Nodes used once are fused into the
+    evaluation of their user, while the results of other evaluated nodes are memoized. Nodes are
+    only shared while a playlist or another node uses them, so a graph and its memoized results
+    are freed once its playlists are evaluated.
+    """
+
+    nodes = weakref.WeakValueDictionary()  # key -> node, for sharing
+
+    def __init__(self, key):
+        self.key = key
+        self.refs = 0
+        self.result = None  # Memoized tracks, as a tuple
+
+    def evaluate(self) -> tuple:
+        """Get the tracks of this expression."""
+        raise NotImplementedError
+
+    @classmethod
+    def clear(cls):
+        """Forget every shared node and memoized result."""
+        cls.nodes.clear()
+
+
+class Leaf(Expression):
+    """Maintain the tracks of a playlist or track list at the time it was used."""
+
+    def __init__(self, key, tracks: Iterable, owner=None):
+        super().__init__(key)
+        self.result = tuple(tracks)
+        self.owner = owner  # Keeps the owner alive so its id is not reused while the key is
+
+    @classmethod
+    def of_playlist(cls, playlist) -> "Leaf":
+        """Get the shared leaf of a playlist at its current version."""
+        key = ("leaf", id(playlist), playlist.version)
+        node = cls.nodes.get(key)
+        if node is None:
+            node = cls(key, playlist.tracks, playlist)
+            cls.nodes[key] = node
+        return node
+
+    @classmethod
+    def of_tracks(cls, tracks: Iterable) -> "Leaf":
+        """Get an unshared leaf of a track list."""
+        tracks = tuple(tracks)
+        return cls(("leaf", id(tracks)), tracks)
+
+    def evaluate(self) -> tuple:
+        return self.result
+
+
+class Operation(Expression):
+    """Maintain a membership operation on two expressions.
+
+    :param operation: one of OPERATIONS, which fuse knows how to apply to deduplicated tracks
+    :param function: applies the operation to a list of tracks in place, keeping duplicates
+    :param dedupe: whether duplicate tracks are removed after the operation
+    """
+
+    def __init__(
+        self,
+        key,
+        operation: str,
+        function: Callable[[list, Sequence], list],
+        left: Expression,
+        right: Expression,
+        dedupe: bool,
+    ):
+        super().__init__(key)
+        self.operation = operation
+        self.function = function
+        self.left = left
+        self.right = right
+        self.dedupe = dedupe
+
+    @classmethod
+    def of(
+        cls,
+        operation: str,
+        function: Callable[[list, Sequence], list],
+        left: Expression,
+        right: Expression,
+        dedupe: bool,
+    ) -> "Operation":
+        """Get the shared node of an operation, counting the use of each operand."""
+        if operation not in OPERATIONS:
+            raise ValueError(f"Unknown operation {operation}, expected one of {OPERATIONS}")
+        key = (operation, id(left), id(right), dedupe)  # Operands live as long as the node
+        node = cls.nodes.get(key)
+        if node is None:
+            node = cls(key, operation, function, left, right, dedupe)
+            cls.nodes[key] = node
+            left.refs += 1
+            right.refs += 1
+        return node
+
+    def evaluate(self) -> tuple:
+        """Get the tracks of this expression.
+
+        The chain of unshared operations down the left operands is fused into a single pass.
+        """
+        if self.result is not None:
+            return self.result
+
+        steps = []
+        node = self
+        while (
+            isinstance(node, Operation)
+            and node.result is None
+            and (node is self or node.refs <= 1)
+        ):
+            steps.append(node)
+            node = node.left
+        steps.reverse()
+
+        self.result = fuse(node.evaluate(), steps)
+        return self.result
+
+
+def fuse(tracks: Sequence, steps: Sequence[Operation]) -> tuple:
+    """Apply a chain of operations to tracks in a single pass.
+
+    Deduplicated results are kept in one OrderedDict which each operation updates in place.
+    """
+    unique = None  # Deduplicated tracks, once a deduplicating operation has run
+    for step in steps:
+        other = step.right.evaluate()
+        if not step.dedupe:
+            tracks = step.function(list(tracks if unique is None else unique), other)
+            unique = None
+            continue
+
+        if unique is None:
+            if step.operation == "sub":  # Duplicates in tracks are removed one for one
+                unique = OrderedDict.fromkeys(step.function(list(tracks), other))
+                continue
+            unique = OrderedDict.fromkeys(tracks)
+
+        if step.operation == "add":
+            unique.update(OrderedDict.fromkeys(other))
+        elif step.operation == "sub":
+            for track in other:
+                unique.pop(track, None)
+        else:
+            unique = OrderedDict.fromkeys(track for track in other if track in unique)
+
+    return tuple(tracks if unique is None else unique)
+
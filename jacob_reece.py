@@ -1,4 +1,5 @@
 import random
+import sys
 from collections import OrderedDict
 from statistics import mode
 
@@ -28,9 +29,13 @@ MAX_SCALE_UNIMPORTANT = 1  # Multiply max important weight by this scale to get
 ASK_UPDATE = False  # Ask for confirmation before updating the playlist
 FUZZY_DUPE_CHECKING = True
 
+pl.DRY_RUN = "--dry-run" in sys.argv  # Plan and report API calls without writing
+
 creds = pl.get_credentials()
-spotify = pl.get_spotify(creds["spotify"])
+# Dry runs read from the cache, so no client is built and no token refreshed
+spotify = None if pl.DRY_RUN else pl.get_spotify(creds["spotify"])
 
+pl.get_catalog(spotify).resolve(spotify, FAMILY_PLAYLISTS + (BLACK_LIST_PLAYLIST,))
 playlists = [pl.Playlist(spotify, None, id_, True) for id_ in FAMILY_PLAYLISTS]
 cum_wait = OrderedDict((player.id, 0) for player in playlists)
 
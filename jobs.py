@@ -0,0 +1,160 @@
+"""Run jobs concurrently once the resources they read are loaded or produced."""
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+JOB_WORKERS = 4  # Number of jobs and loads to run at once
+
+
+class Job:
+    """Maintain a function with the resources it reads and the resources it produces.
+
+    The function is called with each input as a keyword argument and returns a dict of its outputs.
+    Inputs are shared between jobs and must not be modified.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        function: Callable[..., Optional[Dict]],
+        inputs: Sequence[str] = (),
+        outputs: Sequence[str] = (),
+    ):
+        self.name = name
+        self.function = function
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+
+    def __repr__(self):
+        return f"Job(name={self.name}, inputs={self.inputs}, outputs={self.outputs})"
+
+
+class JobReport:
+    """Maintain the start and end times of the jobs and loads in a run."""
+
+    def __init__(
+        self,
+        timings: Dict[str, Tuple[float, float]],
+        dependencies: Dict[str, Sequence[str]],
+    ):
+        self.timings = timings  # Task -> (start, end), in order of completion
+        self.dependencies = dependencies  # Task -> tasks it waited for
+
+    def __str__(self):
+        lines = [f"{name:<30} {seconds:>7.2f}s" for name, seconds in self.durations.items()]
+        path, seconds = self.critical_path()
+        lines.append(f"{'Critical path':<30} {seconds:>7.2f}s ({' -> '.join(path)})")
+        lines.append(f"{'Wall time':<30} {self.elapsed:>7.2f}s")
+        lines.append(f"{'Sequential time':<30} {sum(self.durations.values()):>7.2f}s")
+        return "\n".join(lines)
+
+    @property
+    def durations(self) -> Dict[str, float]:
+        """Get the wall time of each task."""
+        return {name: end - start for name, (start, end) in self.timings.items()}
+
+    @property
+    def elapsed(self) -> float:
+        """Get the wall time of the whole run."""
+        if not self.timings:
+            return 0.0
+        starts, ends = zip(*self.timings.values())
+        return max(ends) - min(starts)
+
+    def critical_path(self) -> Tuple[List[str], float]:
+        """Get the chain of dependent tasks with the longest total wall time, and that time."""
+        durations = self.durations
+        finish = {}  # Task -> (time of its longest chain, previous task in the chain)
+        for name in self.timings:  # Dependencies complete first
+            previous = max(
+                self.dependencies[name], key=lambda dep: finish[dep][0], default=None
+            )
+            before = finish[previous][0] if previous is not None else 0.0
+            finish[name] = (before + durations[name], previous)
+
+        if not finish:
+            return [], 0.0
+        name = max(finish, key=lambda task: finish[task][0])
+        seconds = finish[name][0]
+        path = []
+        while name is not None:
+            path.append(name)
+            name = finish[name][1]
+        return path[::-1], seconds
+
+
+def run_jobs(
+    jobs: Sequence[Job],
+    loaders: Dict[str, Callable[[], object]],
+    selected: Optional[Iterable[str]] = None,
+    workers: Optional[int] = None,
+) -> Tuple[Dict[str, object], JobReport]:
+    """Run the selected jobs, each once its inputs are available.
+
+    Inputs produced by another selected job are taken from it. Other inputs are loaded once by
+    their loader, however many jobs read them.
+    :param selected: names of the jobs to run, in any order. Defaults to every job
+    :param workers: number of jobs and loads to run at once. Defaults to JOB_WORKERS
+    :returns: every loaded and produced resource, and the timings of the run
+    """
+    jobs_by_name = {job.name: job for job in jobs}
+    if selected is None:
+        selected = jobs_by_name
+    selected = set(selected)
+    unknown = selected - set(jobs_by_name)
+    if unknown:
+        raise ValueError(
+            f"Unknown jobs {sorted(unknown)}, expected some of {list(jobs_by_name)}"
+        )
+    active = [job for job in jobs if job.name in selected]
+
+    producers = {output: job.name for job in active for output in job.outputs}
+    tasks = {}  # Task -> (function returning outputs, tasks it waits for)
+    for job in active:
+        dependencies = []
+        for name in job.inputs:
+            if producers.get(name, job.name) != job.name:
+                dependencies.append(producers[name])
+                continue
+            if name not in loaders:
+                raise ValueError(f"No job or loader provides {name} for job {job.name}")
+            load = f"load {name}"
+            tasks[load] = (lambda name=name: {name: loaders[name]()}, ())
+            dependencies.append(load)
+        tasks[job.name] = (lambda job=job: call_job(job, resources), dependencies)
+
+    resources = {}
+    timings = {}
+    workers = JOB_WORKERS if workers is None else workers
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        pending = dict(tasks)
+        running = {}
+        while pending or running:
+            for name, (function, dependencies) in list(pending.items()):
+                if all(dependency in timings for dependency in dependencies):
+                    running[executor.submit(timed, function)] = name
+                    del pending[name]
+            if not running:
+                raise ValueError(f"Jobs {list(pending)} depend on each other")
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                start, end, outputs = future.result()
+                resources.update(outputs or {})
+                timings[name] = (start, end)
+
+    dependencies = {name: tuple(tasks[name][1]) for name in timings}
+    return resources, JobReport(timings, dependencies)
+
+
+def call_job(job: Job, resources: Dict[str, object]) -> Optional[Dict]:
+    """Call a job with its inputs."""
+    return job.function(**{name: resources[name] for name in job.inputs})
+
+
+def timed(function: Callable[[], object]) -> Tuple[float, float, object]:
+    """Call a function, timing it."""
+    start = time.perf_counter()
+    result = function()
+    return start, time.perf_counter(), result
@@ -0,0 +1,218 @@
+"""Load top tracks from last.fm with as few requests as possible."""
+import hashlib
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from typing import Callable, Collection, Iterable, List, Optional, Tuple
+
+import pylast
+
+from cache import DiskCache, load_json, save_json, dump_tracks, load_tracks
+from utility import Track, CLEANED_FIELDS
+
+# Available periods as per last.fm docs (NOT PYLAST DOCS): overall | 7day | 1month | 3month | 6month | 12month
+# Using pylast period format (PERIOD_OVERALL | PERIOD_7DAYS | PERIOD_1MONTH | etc) just returns results for overall
+TOP_PERIODS = (
+    (150, "overall"),
+    (100, "3month"),
+    (30, "1month"),
+    (10, "7day"),
+)  # Number of top tracks to get for each period
+LASTFM_WORKERS = 4  # Number of last.fm requests to make at once
+ALBUM_TTL = 90 * 24 * 60 * 60  # Time to reuse the album of a track
+ALBUM_NEGATIVE_TTL = 7 * 24 * 60 * 60  # Time to reuse a track having no album
+ALBUM_CACHE_SIZE = 20000  # Number of track albums to keep
+RESOLUTION_MISS_TTL = 7 * 24 * 60 * 60  # Time before a track which was not found is looked for again
+RESOLUTION_UNUSED_TTL = 180 * 24 * 60 * 60  # Time to keep resolutions of tracks no longer listened to
+
+ALBUM_CACHE = DiskCache("lastfm_albums", ALBUM_TTL, ALBUM_NEGATIVE_TTL, ALBUM_CACHE_SIZE)
+
+
+def get_lastfm(l_creds):
+    """Get the lastfm network object from which to make requests."""
+    lastfm_password = l_creds["password"]
+    lastfm_pass_hash = pylast.md5(lastfm_password)
+    return pylast.LastFMNetwork(
+        api_key=l_creds["api_key"],
+        api_secret=l_creds["api_secret"],
+        username=l_creds["username"],
+        password_hash=lastfm_pass_hash,
+    )
+
+
+def get_top_tracks(
+    user: pylast.User, periods=TOP_PERIODS, workers: Optional[int] = None
+) -> List[Track]:
+    """Get the top tracks of a user for every period in order, without duplicates.
+
+    Periods are requested at once. Name and artist come with the top tracks, while albums are
+    looked up at once for tracks whose album is not cached.
+    :param workers: number of requests to make at once. Defaults to LASTFM_WORKERS
+    """
+    workers = LASTFM_WORKERS if workers is None else workers
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        results = executor.map(
+            lambda period: user.get_top_tracks(limit=period[0], period=period[1]),
+            periods,
+        )
+        results = list(chain.from_iterable(results))
+
+        items = {}
+        for result in results:
+            name = result.item.get_name()
+            artist = None
+            try:
+                artist = result.item.get_artist().get_name()
+            except AttributeError:
+                warnings.warn(f"No artist associated with {name}")
+            items.setdefault((name, artist), result.item)
+
+        albums = executor.map(
+            get_album, items.values(), [artist for _, artist in items]
+        )
+        return [
+            Track(name=name, album=album, artist=artist)
+            for (name, artist), album in zip(items, albums)
+        ]
+
+
+def get_album(item: pylast.Track, artist: Optional[str]) -> Optional[str]:
+    """Get the album name of a last.fm track, or None if it has none. Cached on disk."""
+    key = f"{artist}\t{item.get_name()}"
+    cached = ALBUM_CACHE.get(key)
+    if cached is not None:
+        return cached[0]
+
+    try:
+        album = item.get_album().get_name()
+    except AttributeError:  # No album associated with the track
+        album = None
+    ALBUM_CACHE.set(key, [album], negative=album is None)
+    return album
+
+
+class ResolutionTable:
+    """Maintain last.fm tracks resolved to Spotify tracks, and those not found, on disk.
+
+    Each entry records its source: "library", "search" or "miss". Library matches are checked again
+    by revalidate when the library changes, while misses are looked for again after
+    RESOLUTION_MISS_TTL.
+    """
+
+    def __init__(self, name: str = "lastfm_resolutions"):
+        self.name = name
+        data = load_json(name, default={})
+        tracks = load_tracks(data["tracks"]) if data else []
+        self.library = data.get("library")  # Fingerprint of the library last matched against
+        self.entries = {}  # Key -> track, source, time resolved and time last used
+        for key, entry in data.get("entries", {}).items():
+            if entry["track"] is not None:
+                entry["track"] = tracks[entry["track"]]
+            self.entries[key] = entry
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def key(target: Track) -> str:
+        """Get the key of a last.fm track."""
+        return "\t".join(field or "" for field in (target.name, target.artist, target.album))
+
+    @staticmethod
+    def target(key: str) -> Track:
+        """Get the last.fm track of a key."""
+        name, artist, album = (field or None for field in key.split("\t"))
+        return Track(name=name, album=album, artist=artist)
+
+    def get(self, target: Track) -> Tuple[bool, Optional[Track]]:
+        """Get whether a last.fm track is resolved and its Spotify track, or None if not found."""
+        entry = self.entries.get(self.key(target))
+        if entry is None:
+            return False, None
+        now = time.time()
+        if entry["source"] == "miss" and now - entry["time"] > RESOLUTION_MISS_TTL:
+            return False, None
+        entry["used"] = now
+        return True, entry["track"]
+
+    def set(self, target: Track, track: Optional[Track], source: str):
+        """Record the Spotify track a last.fm track resolves to, found through source."""
+        now = time.time()
+        self.entries[self.key(target)] = {
+            "track": track,
+            "source": source if track is not None else "miss",
+            "time": now,
+            "used": now,
+        }
+
+    def revalidate(
+        self,
+        library: str,
+        targets: Iterable[Track],
+        match_library: Callable[[Track], Optional[Track]],
+        library_tracks: Collection[Track],
+    ) -> int:
+        """Match resolved tracks against the library again if it changed since the last run.
+
+        Every library match is checked, along with the other entries of targets. Library matches
+        still in library_tracks with the same name and artist are kept. Other entries are matched
+        again, and library matches which no longer match are forgotten so they are resolved from
+        scratch.
+        :param library: fingerprint of the library from library_fingerprint
+        :returns: number of entries changed
+        """
+        if library == self.library:
+            return 0
+
+        checked = {self.key(target): target for target in targets}
+        for key, entry in self.entries.items():
+            if entry["source"] == "library" and key not in checked:
+                checked[key] = self.target(key)
+
+        exact = [CLEANED_FIELDS.index(field) for field in ("name", "artist")]
+        changed = 0
+        for key, target in checked.items():
+            entry = self.entries.get(key)
+            if entry is None or (
+                entry["source"] == "library"
+                and entry["track"] in library_tracks
+                and all(entry["track"].cleaned[i] == target.cleaned[i] for i in exact)
+            ):
+                continue  # Exact name and artist matches cannot be improved on
+            match = match_library(target)
+            if match is not None:
+                if match != entry["track"]:
+                    self.set(target, match, "library")
+                    self.entries[key]["used"] = entry["used"]  # Revalidating is not a use
+                    changed += 1
+            elif entry["source"] == "library":
+                del self.entries[key]
+                changed += 1
+        self.library = library
+        return changed
+
+    def save(self):
+        """Save the entries used within RESOLUTION_UNUSED_TTL."""
+        now = time.time()
+        tracks = []
+        entries = {}
+        for key, entry in self.entries.items():
+            if now - entry["used"] > RESOLUTION_UNUSED_TTL:
+                continue
+            entry = dict(entry)
+            if entry["track"] is not None:
+                tracks.append(entry["track"])
+                entry["track"] = len(tracks) - 1
+            entries[key] = entry
+        data = {"library": self.library, "entries": entries, "tracks": dump_tracks(tracks)}
+        save_json(data, self.name)
+
+
+def library_fingerprint(tracks: Iterable[Track]) -> str:
+    """Get a digest which changes whenever tracks are added to or removed from a library."""
+    digest = hashlib.sha1()
+    for track in sorted(f"{track.id}\t{track.name}" for track in tracks):
+        digest.update(track.encode("utf-8"))
+        digest.update(b"\n")
+    return digest.hexdigest()
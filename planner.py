@@ -0,0 +1,254 @@
+"""Plan the Spotify API calls which turn an online playlist into a local one."""
+import reprlib
+from bisect import bisect_left
+from collections import namedtuple, Counter
+from typing import Sequence
+
+from utility import Track
+
+API_LIMIT = 50
+
+Remove = namedtuple("Remove", "tracks positions")
+Reorder = namedtuple("Reorder", "range_start insert_before range_length")
+Add = namedtuple("Add", "tracks position")
+
+ENDPOINTS = {Remove: "remove", Reorder: "reorder", Add: "add"}
+
+
+class PublishPlan:
+    """Maintain the operations which update an online playlist to match a list of tracks.
+
+    Operations are ordered and every position refers to the online playlist as left by the
+    preceding operations.
+    """
+
+    def __init__(self, operations: list, tracks: list, missing: list, baseline: int):
+        self.operations = operations
+        self.tracks = tracks  # Expected online tracks once all operations are executed
+        self.missing = missing  # Local files which cannot be added through the API
+        self.baseline = baseline  # Calls made by the previous position by position strategy
+
+    def __repr__(self):
+        return f"PublishPlan(calls={dict(self.calls)}, saved={self.saved})"
+
+    def __len__(self):
+        return len(self.operations)
+
+    def __iter__(self):
+        return iter(self.operations)
+
+    @property
+    def calls(self) -> Counter:
+        """Get the number of API calls per endpoint."""
+        return Counter(ENDPOINTS[type(op)] for op in self.operations)
+
+    @property
+    def saved(self) -> int:
+        """Get the number of API calls saved compared to the position by position strategy."""
+        return self.baseline - len(self.operations)
+
+
+def describe_operation(operation) -> str:
+    """Describe an operation for display."""
+    if isinstance(operation, Reorder):
+        return (
+            f"reorder {operation.range_length} tracks from {operation.range_start} "
+            f"to before {operation.insert_before}"
+        )
+    names = reprlib.repr([track.name for track in operation.tracks])
+    if isinstance(operation, Remove):
+        return f"remove {len(operation.tracks)} tracks at {reprlib.repr(operation.positions)}: {names}"
+    return f"add {len(operation.tracks)} tracks at {operation.position}: {names}"
+
+
+def is_removable(track: Track) -> bool:
+    """Determine whether a track can be removed from a playlist through the API."""
+    return not (
+        track.is_local
+        or (track.available_markets is not None and not track.available_markets)
+    )
+
+
+def tokenize(tracks: Sequence[Track]) -> list:
+    """Pair each track with its occurrence number so duplicate tracks can be told apart."""
+    seen = Counter()
+    tokens = []
+    for track in tracks:
+        tokens.append((track, seen[track]))
+        seen[track] += 1
+    return tokens
+
+
+def longest_increasing(sequence: Sequence[int]) -> set:
+    """Get the indices of a longest strictly increasing subsequence."""
+    tails = []  # Smallest tail value of an increasing run of each length
+    tail_indices = []
+    previous = [None] * len(sequence)
+    for index, value in enumerate(sequence):
+        length = bisect_left(tails, value)
+        if length == len(tails):
+            tails.append(value)
+            tail_indices.append(index)
+        else:
+            tails[length] = value
+            tail_indices[length] = index
+        previous[index] = tail_indices[length - 1] if length else None
+
+    indices = set()
+    index = tail_indices[-1] if tail_indices else None
+    while index is not None:
+        indices.add(index)
+        index = previous[index]
+    return indices
+
+
+def plan_publish(tracks: Sequence[Track], tracks_online: Sequence[Track]) -> PublishPlan:
+    """Plan the fewest removes, reorders and adds which turn tracks_online into tracks.
+
+    Three plans are compared. Each keeps a different set of online tracks in place: every wanted
+    track, the longest run already in the wanted order, or the common prefix. Other removable
+    tracks are removed and re-added in batches, while kept tracks out of order are moved in blocks.
+    """
+    local_tokens = tokenize(tracks)
+    online_tokens = tokenize(tracks_online)
+    wanted = set(local_tokens)
+    fixed = {
+        token
+        for token in online_tokens
+        if token in wanted or not is_removable(token[0])
+    }
+
+    rank = {token: index for index, token in enumerate(local_tokens)}
+    ordered = [token for token in online_tokens if token in wanted]
+    in_order = {
+        ordered[index]
+        for index in longest_increasing([rank[token] for token in ordered])
+    }
+    prefix = set()
+    for local_token, online_token in zip(local_tokens, online_tokens):
+        if local_token != online_token:
+            break
+        prefix.add(local_token)
+
+    plans = []
+    for keep in (fixed, in_order, prefix):
+        keep = {
+            token for token in fixed if token in keep or not is_removable(token[0])
+        }
+        plans.append(build_plan(local_tokens, online_tokens, keep))
+    operations, final, missing = min(plans, key=lambda plan: len(plan[0]))
+    return PublishPlan(
+        operations, final, missing, positional_calls(tracks, tracks_online)
+    )
+
+
+def build_plan(local_tokens: list, online_tokens: list, keep: set) -> tuple:
+    """Plan operations which remove every removable online track not in keep.
+
+    Kept tracks outside the longest correctly ordered run are moved in blocks. Missing tracks,
+    including any removed wanted tracks, are then added in runs of sequential positions.
+    :returns: operations, expected online tracks afterwards and local files which could not be added
+    """
+    operations = []
+    wanted = set(local_tokens)
+
+    # Remove tracks not kept, last first so earlier positions stay valid
+    extra = [pos for pos, token in enumerate(online_tokens) if token not in keep]
+    for end in range(len(extra), 0, -API_LIMIT):
+        positions = extra[max(0, end - API_LIMIT) : end]
+        operations.append(
+            Remove([online_tokens[pos][0] for pos in positions], positions)
+        )
+    current = [token for token in online_tokens if token in keep]
+
+    # Move tracks outside the longest correctly ordered run
+    present = set(current)
+    desired = [token for token in local_tokens if token in present]
+    desired += [token for token in current if token not in wanted]
+    rank = {token: index for index, token in enumerate(desired)}
+    kept = {
+        current[index]
+        for index in longest_increasing([rank[token] for token in current])
+    }
+    index = 0
+    while index < len(desired):
+        token = desired[index]
+        if token in kept:
+            index += 1
+            continue
+        start = current.index(token)
+        length = 1
+        while (
+            index + length < len(desired)
+            and desired[index + length] not in kept
+            and start + length < len(current)
+            and current[start + length] == desired[index + length]
+        ):
+            length += 1
+        insert_before = current.index(desired[index - 1]) + 1 if index else 0
+        if insert_before != start:
+            operations.append(Reorder(start, insert_before, length))
+            block = current[start : start + length]
+            del current[start : start + length]
+            if insert_before > start:
+                insert_before -= length
+            current[insert_before:insert_before] = block
+        index += length
+
+    # Add missing tracks in runs of sequential positions
+    missing = [
+        token[0]
+        for token in local_tokens
+        if token not in present and token[0].is_local
+    ]
+    final = [
+        token for token in local_tokens if token in present or not token[0].is_local
+    ]
+    final += [token for token in current if token not in wanted]
+    run = []
+    for pos, token in enumerate(final):
+        if token not in present:
+            if run and (run[-1][0] + 1 != pos or len(run) >= API_LIMIT):
+                operations.append(Add([t for _, t in run], run[0][0]))
+                run = []
+            run.append((pos, token[0]))
+    if run:
+        operations.append(Add([t for _, t in run], run[0][0]))
+
+    return operations, [token[0] for token in final], missing
+
+
+def positional_calls(tracks: Sequence[Track], tracks_online: Sequence[Track]) -> int:
+    """Count the API calls of the position by position strategy which plan_publish replaced.
+
+    Tracks are compared position by position, every online track after the first mismatch is
+    removed and missing tracks are re-added.
+    """
+    tracks_online = list(tracks_online)
+    calls = 0
+    online_index = 0
+    new_positions = []
+    for track in tracks:
+        if online_index < len(tracks_online) and track == tracks_online[online_index]:
+            online_index += 1
+            continue
+        if track.is_local:
+            if track in tracks_online[online_index:]:
+                shifted_index = tracks_online.index(track, online_index)
+                tracks_online.insert(online_index, tracks_online.pop(shifted_index))
+                calls += 1
+                online_index += 1
+        else:
+            new_positions.append(online_index + len(new_positions))
+
+    extra = tracks_online[online_index:]
+    calls += -(-len(extra) // API_LIMIT)  # One call per batch, even with only local files
+    calls += sum(1 for track in extra if not is_removable(track))
+
+    run = 0
+    for num, pos in enumerate(new_positions):
+        if not run or pos != new_positions[num - 1] + 1 or run >= API_LIMIT:
+            calls += 1
+            run = 0
+        run += 1
+    return calls
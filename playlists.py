@@ -1,10 +1,24 @@
 """Create dynamic Spotify playlists using Playlist objects."""
 import json
+import os
 import reprlib
+import threading
+import time
 import warnings
-from collections import namedtuple
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
 from itertools import chain
-from typing import Iterable, List, Mapping, Dict, Optional, OrderedDict
+from urllib.parse import urlsplit, urlunsplit, parse_qs, urlencode
+from typing import (
+    Callable,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Dict,
+    Optional,
+    OrderedDict,
+)
 
 import spotipy
 from spotipy import util
@@ -12,16 +26,46 @@ from spotipy import util
 # TODO: Remove duplicates
 from tqdm import tqdm
 
+from cache import (
+    cache_path,
+    load_json,
+    save_json,
+    dump_tracks,
+    load_tracks,
+    DiskCache,
+)
+from client import SharedSpotify
+from expressions import Expression, Leaf, Operation
+from planner import (
+    plan_publish,
+    describe_operation,
+    PublishPlan,
+    Remove,
+    Reorder,
+    API_LIMIT,
+)
 from utility import find_match, clean, remove_extra, Track, TRACK_FIELDS, TRACK_ROOT
 
 print = tqdm.write
 
 CREDS_FILE = "creds.json"
 
-PLAYLIST_FIELDS = {"id": ("id",), "name": ("name",)}
+PLAYLIST_FIELDS = {"id": ("id",), "name": ("name",), "snapshot_id": ("snapshot_id",)}
 
-API_LIMIT = 50
 USER_MARKET = "US"
+DRY_RUN = False  # Plan publishes without writing and read playlists from the cache when possible
+PLANNED_CALLS = Counter()  # Write API calls planned by every publish, per endpoint
+LAZY = False  # Record playlist operators in a shared expression graph, evaluated when tracks are read
+PUBLISHED = {}  # Playlist id -> tracks online after the last publish, reused when LAZY
+PAGE_WORKERS = 8  # Number of result pages to request at once
+PAGE_FIELDS = ("next", "total", "limit", "offset")  # Page fields used by get_all
+SEARCH_WORKERS = 3  # Number of album variants to search for at once in parallel mode
+FULL_SYNC_SECONDS = 7 * 24 * 60 * 60  # Time between full reloads of saved songs to catch removals
+SEARCH_TTL = 30 * 24 * 60 * 60  # Time to reuse search results
+SEARCH_NEGATIVE_TTL = 24 * 60 * 60  # Time to reuse searches without results
+SEARCH_CACHE_SIZE = 20000  # Number of searches to keep
+
+SEARCH_CACHE = DiskCache("search", SEARCH_TTL, SEARCH_NEGATIVE_TTL, SEARCH_CACHE_SIZE)
 
 
 class Playlist:
@@ -37,6 +81,8 @@ class Playlist:
     ):
         self.spotify = spotify
         self.name = name
+        self.version = 0  # Incremented on every change to tracks
+        self._expression = None
         self.tracks: list = []
         self.id = id_
         self.allow_duplicates = allow_duplicates
@@ -47,6 +93,43 @@ class Playlist:
         if self.id is not None and populate:
             self.load_tracks_from_spotify()
 
+    @property
+    def tracks(self) -> list:
+        """Get the list of tracks. Mutate through Playlist methods to keep version current.
+
+        A pending expression is evaluated first.
+        """
+        expression = self._expression
+        if expression is not None:
+            self._tracks = list(expression.evaluate())
+            if self._expression is expression:  # Not already evaluated by another job
+                expression.refs -= 1
+                self._expression = None
+        return self._tracks
+
+    @tracks.setter
+    def tracks(self, tracks: list):
+        self._tracks = tracks
+        self.expression = None
+
+    @property
+    def expression(self) -> Optional[Expression]:
+        """Get the expression which gives the tracks once evaluated, if any."""
+        return self._expression
+
+    @expression.setter
+    def expression(self, expression: Optional[Expression]):
+        if self._expression is not None:
+            self._expression.refs -= 1
+        if expression is not None:
+            expression.refs += 1
+        self._expression = expression
+        self.version += 1
+
+    def clear(self):
+        """Remove all tracks from the playlist."""
+        self.tracks = []
+
     def __repr__(self):
         tracks = [track.name for track in self.tracks]
         return f"Playlist(name={self.name}, tracks={reprlib.repr(tracks)})"
@@ -54,15 +137,15 @@ class Playlist:
     def __add__(self, other):
         """Add tracks from both playlists or track list."""
         # Set addition is really union "or"
-        return self._membership_op(other, lambda s, o: list(chain(s, o)))
+        return self._membership_op(other, "add")
 
     def __sub__(self, other):
         """Remove tracks in right playlist from left playlist."""
-        return self._membership_op(other, sub_lists)
+        return self._membership_op(other, "sub")
 
     def __and__(self, other):
         """Intersect tracks of both playlists."""
-        return self._membership_op(other, intersect_lists)
+        return self._membership_op(other, "and")
 
     def __or__(self, other):
         """Combine tracks of both playlists."""
@@ -71,22 +154,28 @@ class Playlist:
     def __iadd__(self, other):
         """Add tracks from both playlists or track list inplace."""
         # Set addition is really union "or"
-        return self._membership_op(other, lambda s, o: list(chain(s, o)), True)
+        return self._membership_op(other, "add", True)
 
     def __isub__(self, other):
         """Remove tracks in right playlist from left playlist inplace."""
-        return self._membership_op(other, sub_lists, True)
+        return self._membership_op(other, "sub", True)
 
     def __iand__(self, other):
         """Intersect tracks of both playlists inplace."""
-        return self._membership_op(other, intersect_lists, True)
+        return self._membership_op(other, "and", True)
 
     def __ior__(self, other):
         """Combine tracks of both playlists inplace."""
         return self.__iadd__(other)
 
     def _membership_op(self, other, operation, inplace=False):
-        """Perform a membership operation on the Playlist."""
+        """Perform a membership operation on the Playlist.
+
+        :param operation: name of the operation in OPERATIONS
+        """
+        if LAZY:
+            return self._lazy_membership_op(other, operation, inplace)
+        operation = OPERATIONS[operation]
         if inplace:
             new = self
         else:
@@ -98,7 +187,7 @@ class Playlist:
             new.tracks = operation(new.tracks, [other])
         else:  # Could check for inplace here to stop non-augmented operations from accepting types other than Playlist
             try:
-                tracks = list(other)
+                tracks = iter(other)  # Iterated once, so tracks may be streamed
             except TypeError:
                 return NotImplemented
             new.tracks = operation(new.tracks, tracks)
@@ -106,6 +195,34 @@ class Playlist:
             new.tracks = list(OrderedDict.fromkeys(new.tracks))
         return new
 
+    def _lazy_membership_op(self, other, operation, inplace=False):
+        """Record a membership operation in the expression graph. See _membership_op."""
+        if isinstance(other, Playlist):
+            right = other._node()
+        elif isinstance(other, Track):
+            right = Leaf.of_tracks([other])
+        else:
+            try:
+                right = Leaf.of_tracks(other)
+            except TypeError:
+                return NotImplemented
+        expression = Operation.of(
+            operation,
+            OPERATIONS[operation],
+            self._node(),
+            right,
+            dedupe=not self.allow_duplicates,
+        )
+        new = self if inplace else Playlist(self.spotify, self.name, self.id)
+        new.expression = expression
+        return new
+
+    def _node(self) -> Expression:
+        """Get the expression of the current tracks."""
+        if self._expression is not None:
+            return self._expression
+        return Leaf.of_playlist(self)
+
     def __bool__(self):
         """Determine truthiness of Playlist."""
         return bool(self.tracks)
@@ -124,24 +241,34 @@ class Playlist:
     def copy(self):
         """Copy tracks into new playlist."""
         new = Playlist(self.spotify, self.name, self.id, populate=False)
-        new.tracks = self.tracks[:]
+        if self._expression is not None:
+            new.expression = self._expression
+        else:
+            new.tracks = self.tracks[:]
         return new
 
     def load_tracks_from_spotify(self):
-        """Overwrite the playlist with tracks from the playlist id."""
-        self.tracks = list(get_playlist_tracks(self.spotify, self.id))
+        """Overwrite the playlist with tracks from the playlist id.
+
+        When LAZY, the tracks left online by an earlier publish are reused.
+        """
+        if LAZY and self.id in PUBLISHED:
+            self.tracks = list(PUBLISHED[self.id])
+            return
+        self.tracks = list(iter_playlist_tracks(self.spotify, self.id))
 
     def _find_id(self):
         """Update id with id from matching playlist name in Spotify."""
-        playlists = get_playlists(self.spotify)
-        name_map = {p["name"]: p["id"] for p in playlists}
-        if self.name in name_map:
-            self.id = name_map[self.name]
+        playlist_id = get_catalog(self.spotify).find_id(self.name)
+        if playlist_id is not None:
+            self.id = playlist_id
 
     def _find_name(self):
         """Update name with name from matching playlist id in Spotify."""
-        playlist = self.spotify.playlist(self.id)
-        self.name = playlist["name"]
+        catalog = get_catalog(self.spotify)
+        if catalog.find(self.id) is None:
+            catalog.resolve(self.spotify, [self.id])
+        self.name = catalog.find(self.id)["name"]
 
     def publish(
         self,
@@ -149,164 +276,129 @@ class Playlist:
         always_new: bool = False,
         public: bool = False,
         desc: str = "",
-    ):
-        """Publish the playlist to spotify."""
-
-        def get_track_name(track_id: str, track_list: Iterable[Track]) -> Optional[str]:
-            """Find a track's name from id in a list of tracks."""
-            for t in track_list:
-                if t.id == track_id:
-                    return t.name
-            return None
-
-        TrackPos = namedtuple("TrackPos", "pos id")
-
+        dry_run: Optional[bool] = None,
+    ) -> PublishPlan:
+        """Publish the playlist to spotify with the fewest API calls planned by plan_publish.
+
+        :param dry_run: only plan and report the API calls. Online tracks are read from the cache
+                        when available and nothing is written. Defaults to DRY_RUN
+        """
+        dry_run = DRY_RUN if dry_run is None else dry_run
         name = self.name if name is None else name
-        user = self.spotify.me()["id"]
-
-        if always_new or self.id is None:
-            playlist = self.spotify.user_playlist_create(user, name, public, desc)
-            self.id = playlist["id"]
-
-        tracks_online_old = get_playlist_tracks(self.spotify, self.id)
-        tracks_online, no_match = update_tracks(self.spotify, tracks_online_old)
-
-        # Move, remove, and add tracks to correct positions
-        new_tracks = []
-        online_index = 0
-        added = 0
-        for current_index in range(len(self.tracks)):
-            if (
-                online_index < len(tracks_online)
-                and self.tracks[current_index] == tracks_online[online_index]
-            ):
-                # Track already in position
-                online_index += 1
-                continue
+        create = always_new or self.id is None
+
+        if dry_run:
+            tracks_online = []
+            # Without a client, playlists never loaded are planned as if empty
+            unsaved = self.spotify is None and not create and not has_saved_tracks(self.id)
+            if not create and not unsaved:
+                tracks_online = get_playlist_tracks(self.spotify, self.id, cached=True)
+        else:
+            user = self.spotify.me()["id"]
+            if create:
+                playlist = self.spotify.user_playlist_create(user, name, public, desc)
+                self.id = playlist["id"]
+                add_playlist(self.spotify, playlist)
+
+            tracks_online_old = get_playlist_tracks(self.spotify, self.id)
+            relinks = Counter()
+            tracks_online, no_match = update_tracks(
+                self.spotify, tracks_online_old, relinks=relinks
+            )
 
-            # Track missing or in wrong position
-            track = self.tracks[current_index]
-            if track.is_local:
-                # Only move local tracks. Otherwise, batch add at end
-                if track in tracks_online[online_index:]:
-                    # Move track to correct position
-                    shifted_track_index = tracks_online.index(track, online_index)
-                    # print(f"Moving track in {self.name}: {track.name} from {shifted_track_index} to {online_index}")
-                    self.spotify.user_playlist_reorder_tracks(
-                        user, self.id, shifted_track_index, online_index
-                    )
-                    # Update local copy
-                    tracks_online.insert(
-                        online_index, tracks_online.pop(shifted_track_index)
-                    )
-                    online_index += 1
-                else:
-                    warnings.warn(
-                        f"No local file for {track} available in "
-                        f"online playlist {self.name} to move to spot {online_index + 1}"
+        plan = plan_publish(self.tracks, tracks_online)
+        for track in plan.missing:
+            warnings.warn(
+                f"No local file for {track} available in online playlist {name} to move"
+            )
+        calls = plan.calls
+        if create:
+            calls["create"] += 1
+        PLANNED_CALLS.update(calls)
+
+        if dry_run:
+            relinks = sum(1 for track in tracks_online if needs_relink(track))
+            unsaved_note = " Online tracks never saved, planned as empty." if unsaved else ""
+            print(
+                f"[Dry run] {name}: {sum(calls.values())} calls {dict(calls)}, "
+                f"{plan.saved} fewer than position by position updates, "
+                f"{relinks} tracks to relink by batch or search.{unsaved_note}"
+            )
+            for operation in plan:
+                print(f"    {describe_operation(operation)}")
+            return plan
+
+        for operation in plan:
+            if isinstance(operation, Remove):
+                # Remove by the ids stored online, which relinking may have replaced
+                track_uri_dicts = [
+                    {"uri": tracks_online_old[pos].id, "positions": [pos]}
+                    for pos in operation.positions
+                ]
+                failed = remove_tracks(self.spotify, track_uri_dicts, self.id, user)
+                if failed:
+                    raise RuntimeError(
+                        f"Failed to remove {[t_uri_dict['uri'] for t_uri_dict in failed]} "
+                        f"from {self.name}"
                     )
-            else:
-                # Track missing from playlist, record position to insert into later
-                new_tracks.append(TrackPos(online_index + added, track.id))
-                added += 1
-
-        # Remove extra tracks at end which are in wrong place
-        num_extra_tracks_local = 0
-        while online_index < len(tracks_online):
-            # Partition tracks to be removed
-            tracks = tracks_online[online_index : online_index + API_LIMIT]
-            # print(f"Removing from {self.name}: ", [t.name for t in tracks],)
-            extra_tracks_uri_dicts = []
-            extra_tracks_local = []
-            extra_tracks_id_map = {}
-            extra_tracks_local_num_map = {}
-            local_files = 0
-            for pos, track in enumerate(tracks):
-                if track.is_local or (
-                    track.available_markets is not None and not track.available_markets
-                ):
-                    index = online_index
-                    local_files += 1
-                    extra_tracks_local.append(index)
-                    extra_tracks_local_num_map[index + local_files] = track
-                else:
-                    track_uri_dict = {
-                        "uri": track.id,
-                        "positions": [online_index + pos],
-                    }
-                    extra_tracks_id_map[track.id] = track
-                    extra_tracks_uri_dicts.append(track_uri_dict)
-
-            # Update local copy
-            for i in range(online_index, online_index + API_LIMIT):
-                if online_index < len(tracks_online):
-                    # Local copy must believe local tracks were removed even though they are actually placed on the end
-                    tracks_online.pop(online_index)
-
-            # Update remote copy
-            failed = remove_tracks(self.spotify, extra_tracks_uri_dicts, self.id, user)
-            if failed:
-                raise RuntimeError(
-                    f"Failed to remove {[extra_tracks_id_map[t_uri_dict['uri']].name for t_uri_dict in failed]} "
-                    f"from {self.name}"
-                )
-
-            num_extra_tracks_local += len(extra_tracks_local)
-            tracks_to_move = [
-                extra_tracks_local_num_map[num + i + 1]
-                for i, num in enumerate(extra_tracks_local)
-            ]
-            for track_pos in extra_tracks_local:
+            elif isinstance(operation, Reorder):
                 self.spotify.user_playlist_reorder_tracks(
                     user,
                     self.id,
-                    track_pos,
-                    len(tracks_online) + num_extra_tracks_local,
+                    operation.range_start,
+                    operation.insert_before,
+                    operation.range_length,
                 )
-            if extra_tracks_local:
-                print(
-                    f"Added {len(extra_tracks_local)} extra local tracks to end of {self.name}: "
-                    f"{[track.name for track in tracks_to_move]}"
+            else:
+                self.spotify.user_playlist_add_tracks(
+                    user,
+                    self.id,
+                    [track.id for track in operation.tracks],
+                    operation.position,  # All tracks must be added from a single pos
                 )
 
-        # Insert missing tracks
-        tracks = []
-        while new_tracks:
-            # Create run of sequential tracks
-            while not tracks or (
-                new_tracks
-                and new_tracks[0].pos == tracks[-1].pos + 1
-                and len(tracks) < API_LIMIT
-            ):
-                tracks.append(new_tracks.pop(0))
-            # print(f"Adding to {self.name}: ", [(get_track_name(t.id, self.tracks), t.pos) for t in tracks],)
-            self.spotify.user_playlist_add_tracks(
-                user,
-                self.id,
-                [track.id for track in tracks],
-                tracks[0].pos,  # All tracks must be added from a single pos
-            )
-            tracks = []
+        if plan.operations:
+            forget_snapshot(self.spotify, self.id, plan.tracks)
+        PUBLISHED[self.id] = tuple(plan.tracks)
 
-        print(f"{self.name} complete.\n")
+        relinked = ""
+        if relinks["batched"] or relinks["searched"]:
+            relinked = (
+                f" Relinked {relinks['batched']} tracks in {relinks['batch calls']} batch calls, "
+                f"saving at least {relinks['batched'] - relinks['batch calls']} searches, "
+                f"and {relinks['searched']} by search."
+            )
+        print(
+            f"{self.name} complete in {sum(calls.values())} calls {dict(calls)}, "
+            f"{plan.saved} fewer than position by position updates.{relinked}\n"
+        )
+        return plan
 
 
-def update_tracks(spotify: spotipy.Spotify, tracks, exclude=False):
+def update_tracks(
+    spotify: spotipy.Spotify, tracks, exclude=False, relinks: Optional[Counter] = None
+):
     """Get links to tracks available in the USER_MARKET.
 
+    Unavailable tracks are first fetched in batches with the USER_MARKET so Spotify can relink
+    them. Only tracks Spotify cannot relink are searched for.
     :param exclude: Remove tracks from playlist if not available in USER_MARKET
+    :param relinks: Counter updated with the batch calls and tracks relinked by batch and by search
     """
+    relinks = Counter() if relinks is None else relinks
+    relinked = relink_tracks(
+        spotify, [track for track in tracks if needs_relink(track)], relinks
+    )
     new_tracks = []
     failed = []
     for track in tracks:
         closest_track = track
-        # if track.available_markets is None, it was found in a search for USER_MARKET and is therefore already updated
-        if (
-            not track.is_local
-            and track.available_markets is not None
-            and not track.available_markets
-        ):
-            best_result = search(spotify, track.name, track.album, track.artist)
+        if needs_relink(track):
+            if track.id in relinked:
+                best_result = relinked[track.id]
+            else:
+                best_result = search(spotify, track.name, track.album, track.artist)
+                relinks["searched"] += 1
 
             if best_result:
                 closest_track = best_result
@@ -330,6 +422,38 @@ def update_tracks(spotify: spotipy.Spotify, tracks, exclude=False):
     return new_tracks, failed
 
 
+def relink_tracks(
+    spotify: spotipy.Spotify, tracks, relinks: Optional[Counter] = None
+) -> Dict[str, Track]:
+    """Get the tracks Spotify relinks to versions playable in USER_MARKET, by requested id.
+
+    :param relinks: Counter updated with the batch calls made and the tracks relinked
+    """
+    relinks = Counter() if relinks is None else relinks
+    ids = list(dict.fromkeys(track.id for track in tracks if track.id))
+    relinked = {}
+    for start in range(0, len(ids), API_LIMIT):
+        results = spotify.tracks(ids[start : start + API_LIMIT], market=USER_MARKET)
+        relinks["batch calls"] += 1
+        items = [item for item in results["tracks"] if item]
+        for track in results_to_tracks(items, []):
+            if track.is_playable:
+                track.available_markets = None  # None indicates correct market
+                relinked[track.id] = track  # Relinked tracks keep the requested id
+    relinks["batched"] += sum(1 for track in tracks if track.id in relinked)
+    return relinked
+
+
+def needs_relink(track: Track) -> bool:
+    """Determine whether a track is unavailable in USER_MARKET and must be searched for."""
+    # if track.available_markets is None, it was found in a search for USER_MARKET and is therefore already updated
+    return (
+        not track.is_local
+        and track.available_markets is not None
+        and not track.available_markets
+    )
+
+
 def remove_tracks(
     spotify: spotipy.Spotify, track_uri_dict: List[Dict], playlist_id: str, user: str
 ) -> List[Dict]:
@@ -355,8 +479,19 @@ def remove_tracks(
     return []
 
 
-def search(spotify: spotipy.Spotify, name, album=None, artist=None, market=USER_MARKET):
-    """Get search results from spotify for a given song."""
+def search(
+    spotify: spotipy.Spotify,
+    name,
+    album=None,
+    artist=None,
+    market=USER_MARKET,
+    parallel=False,
+):
+    """Get search results from spotify for a given song.
+
+    :param parallel: Search album variants up to SEARCH_WORKERS at once, keeping the first variant
+        in order which matches and cancelling the rest
+    """
 
     def create_query(track):
         """Create a search query from a track."""
@@ -382,71 +517,440 @@ def search(spotify: spotipy.Spotify, name, album=None, artist=None, market=USER_
         yield album_
         yield None
 
-    for album_search in album_searches(album):
+    def search_album(album_search):
+        """Get the best match when searching with an album variant."""
         target_track = Track(name=name, album=album_search, artist=artist)
-        results = spotify.search(q=create_query(target_track), market=market)
-        matches = results_to_tracks(results["tracks"]["items"], [])
+        matches = search_tracks(spotify, create_query(target_track), market)
         for track in matches:
             track.available_markets = None  # None indicates correct market due to search in market
-        best_result = find_match(matches, target_track)
-        if best_result:
-            return best_result
+        return find_match(matches, target_track)
+
+    # Variants often repeat, e.g. when the album has nothing to remove
+    album_variants = list(dict.fromkeys(album_searches(album)))
+    if not parallel or len(album_variants) == 1:
+        for album_search in album_variants:
+            best_result = search_album(album_search)
+            if best_result:
+                return best_result
+        return None
+
+    executor = ThreadPoolExecutor(max_workers=SEARCH_WORKERS)
+    futures = []
+    try:
+        futures.extend(executor.submit(search_album, variant) for variant in album_variants)
+        for future in futures:
+            best_result = future.result()
+            if best_result:
+                return best_result
+        return None
+    finally:
+        # Searches not started are cancelled here, as cancel_futures needs Python 3.9
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def search_tracks(spotify: spotipy.Spotify, query: str, market=USER_MARKET) -> List[Track]:
+    """Get the tracks found by a spotify search. Cached on disk by normalized query and market."""
+    key = f"{market}:{' '.join(query.lower().split())}"
+    data = SEARCH_CACHE.get(key)
+    if data is None:
+        results = spotify.search(q=query, market=market)
+        tracks = results_to_tracks(results["tracks"]["items"], [])
+        data = dump_tracks(tracks)
+        SEARCH_CACHE.set(key, data, negative=not tracks)
+    return load_tracks(data)
+
+
+def add_lists(own, other):
+    """Add tracks from other after the tracks in own."""
+    return list(chain(own, other))
 
 
 def sub_lists(own, other):
-    """Remove tracks from own which are present in other inplace."""
-    for track in other:
-        if track in own:
-            own.remove(track)
+    """Remove tracks from own which are present in other inplace.
+
+    Each track in other removes the earliest remaining equal track in own.
+    """
+    counts = Counter(other)
+    new = []
+    for track in own:
+        if counts[track]:
+            counts[track] -= 1
+            continue
+        new.append(track)
+    own[:] = new
     return own
 
 
 def intersect_lists(own, other):
     """Remove tracks from own which are not present in both lists inplace."""
-    new = []
-    for track in other:
-        if track in own:
-            new.append(track)
+    own_tracks = set(own)
+    new = [track for track in other if track in own_tracks]
     own.clear()
     own.extend(new)
     return own
 
 
-def get_playlist_tracks(spotify: spotipy.Spotify, playlist_id: str) -> List[Track]:
-    """Load all songs from the given playlist."""
-    results = get_all(spotify, spotify.playlist_tracks(playlist_id, market=USER_MARKET))
-    for track in results:  # None indicates that search was made with user_market
-        if "available_markets" not in track["track"] or not track["track"]["available_markets"]:
-            track["track"]["available_markets"] = None
-    return results_to_tracks(results)
+OPERATIONS = {"add": add_lists, "sub": sub_lists, "and": intersect_lists}
+
+
+def get_playlist_tracks(
+    spotify: spotipy.Spotify,
+    playlist_id: str,
+    cached: Optional[bool] = None,
+    snapshot_id: Optional[str] = None,
+) -> List[Track]:
+    """Load all songs from the given playlist, reusing the saved tracks if its snapshot is unchanged.
+
+    :param cached: read the tracks saved by the last load regardless of snapshot. Defaults to DRY_RUN
+    :param snapshot_id: the current snapshot of the playlist. Looked up if not provided
+    """
+    return list(iter_playlist_tracks(spotify, playlist_id, cached, snapshot_id))
+
+
+def iter_playlist_tracks(
+    spotify: spotipy.Spotify,
+    playlist_id: str,
+    cached: Optional[bool] = None,
+    snapshot_id: Optional[str] = None,
+) -> Iterator[Track]:
+    """Yield the songs of the given playlist page by page. See get_playlist_tracks.
+
+    Each page of results is released once converted. The tracks are saved once all are loaded.
+    """
+    cached = DRY_RUN if cached is None else cached
+    data = load_json("playlists", playlist_id)
+    if data is not None and cached:
+        yield from load_tracks(data)
+        return
+    if spotify is None:
+        raise missing_cache(f"tracks of playlist {playlist_id}")
+    if snapshot_id is None:
+        snapshot_id = get_snapshot(spotify, playlist_id)
+    if data is not None and data.get("snapshot_id") == snapshot_id:
+        yield from load_tracks(data)
+        return
+
+    tracks = []
+    results = spotify.playlist_tracks(
+        playlist_id, fields=fields_projection(), market=USER_MARKET
+    )
+    for page in iter_pages(spotify, results):
+        for item in page["items"]:  # None indicates that search was made with user_market
+            if "available_markets" not in item["track"] or not item["track"]["available_markets"]:
+                item["track"]["available_markets"] = None
+        for track in iter_tracks(page["items"]):
+            tracks.append(track)
+            yield track
+
+    data = dump_tracks(tracks)
+    data["snapshot_id"] = snapshot_id
+    save_json(data, "playlists", playlist_id)
+
 
+def has_saved_tracks(playlist_id: str) -> bool:
+    """Determine whether the tracks of a playlist were saved by a load or publish."""
+    return os.path.exists(cache_path("playlists", playlist_id))
 
-def get_saved_songs(spotify: spotipy.Spotify):
-    """Load all songs from the users saved songs."""
-    results = get_all(spotify, spotify.current_user_saved_tracks(limit=API_LIMIT))
 
-    return results_to_tracks(results)
+def missing_cache(name: str) -> RuntimeError:
+    """Get the error for reading name without a client when no live run has saved it."""
+    return RuntimeError(
+        f"No cached {name} to read without a Spotify client. "
+        "Run once without --dry-run to fill the cache."
+    )
+
+
+def get_snapshot(spotify: spotipy.Spotify, playlist_id: str) -> str:
+    """Get the current snapshot id of a playlist, preferring the playlist catalog."""
+    catalog = get_catalog(spotify)
+    catalog.resolve(spotify, [playlist_id])
+    return catalog.find(playlist_id)["snapshot_id"]
+
+
+def forget_snapshot(
+    spotify: spotipy.Spotify, playlist_id: str, tracks: Iterable[Track]
+):
+    """Mark the snapshot id of a changed playlist as outdated, saving its published tracks.
+
+    The tracks are saved without a snapshot id so cached loads (dry runs) read them, while other
+    loads fetch the playlist again.
+    """
+    playlist = get_catalog(spotify).find(playlist_id)
+    if playlist is not None:
+        playlist["snapshot_id"] = None
+    data = dump_tracks(tracks)
+    data["snapshot_id"] = None
+    save_json(data, "playlists", playlist_id)
+
+
+def get_saved_songs(
+    spotify: spotipy.Spotify, cached: Optional[bool] = None, full: bool = False
+):
+    """Load all songs from the users saved songs, syncing only songs saved since the last load.
+
+    Songs are listed newest first, so pages are read until a known (id, added_at) pair is reached.
+    Removals are only seen by a full sync, which runs every FULL_SYNC_SECONDS.
+    :param cached: read the songs saved by the last load instead if available. Defaults to DRY_RUN
+    :param full: always reload every saved song
+    """
+    return list(iter_saved_songs(spotify, cached, full))
+
+
+def iter_saved_songs(
+    spotify: spotipy.Spotify, cached: Optional[bool] = None, full: bool = False
+) -> Iterator[Track]:
+    """Yield the users saved songs page by page. See get_saved_songs.
+
+    Each page of results is released once converted. The songs are saved once all are loaded.
+    """
+    cached = DRY_RUN if cached is None else cached
+    data = load_json("saved_songs")
+    if data is not None and cached:
+        yield from load_tracks(data)
+        return
+    if spotify is None:
+        raise missing_cache("saved songs")
+
+    tracks = []
+    added_at = []
+    if (
+        data is None
+        or full
+        or time.time() - data.get("synced", 0) > FULL_SYNC_SECONDS
+        or len(data.get("added_at", ())) != len(data["tracks"])
+    ):
+        results = spotify.current_user_saved_tracks(limit=API_LIMIT)
+        for page in iter_pages(spotify, results):
+            added_at.extend(result["added_at"] for result in page["items"])
+            for track in iter_tracks(page["items"]):
+                tracks.append(track)
+                yield track
+        synced = time.time()
+    else:
+        known = {
+            (fields["id"], added)
+            for fields, added in zip(data["tracks"], data["added_at"])
+        }
+        new_ids = set()
+        results = spotify.current_user_saved_tracks(limit=API_LIMIT)
+        while True:
+            new_results = []
+            for result in results["items"]:
+                if (result["track"]["id"], result["added_at"]) in known:
+                    break
+                new_results.append(result)
+            else:
+                new_results = None  # Every song on the page is new
+
+            page_results = results["items"] if new_results is None else new_results
+            new_ids.update(result["track"]["id"] for result in page_results)
+            added_at.extend(result["added_at"] for result in page_results)
+            for track in iter_tracks(page_results):
+                tracks.append(track)
+                yield track
+
+            if new_results is not None or not results["next"]:
+                break
+            results = spotify.next(results)
+
+        # Songs saved again move to the top
+        for track, added in zip(load_tracks(data), data["added_at"]):
+            if track.as_dict()["id"] not in new_ids:
+                tracks.append(track)
+                added_at.append(added)
+                yield track
+        synced = data["synced"]
+
+    data = dump_tracks(tracks)
+    data["added_at"] = added_at
+    data["synced"] = synced
+    save_json(data, "saved_songs")
+
+
+def get_playlists(
+    spotify: spotipy.Spotify, reload=False, cached: Optional[bool] = None
+) -> List[Dict[str, str]]:
+    """Get a list of user playlist names and ids. Memoized.
+
+    :param cached: read the list saved by the last load instead if available. Defaults to DRY_RUN
+    """
+    return get_catalog(spotify, reload, cached).playlists
+
+
+def get_catalog(
+    spotify: spotipy.Spotify, reload=False, cached: Optional[bool] = None
+) -> "PlaylistCatalog":
+    """Get the catalog of user playlists. Memoized.
+
+    :param cached: read the lists saved by the last load instead if available, including the
+                   playlists resolved outside the user's list. Defaults to DRY_RUN
+    """
+    cached = DRY_RUN if cached is None else cached
+    if "catalog" not in get_catalog.__dict__ or reload:
+        playlists = load_json("playlists") if cached else None
+        unlisted = load_json("playlists_unlisted", default=[]) if cached else []
+        if playlists is None:
+            if spotify is None:
+                raise missing_cache("playlist list")
+            playlists = get_all(spotify, spotify.current_user_playlists())
+            playlists = select_fields(playlists, fields=PLAYLIST_FIELDS)
+            save_json(playlists, "playlists")
+        get_catalog.catalog = PlaylistCatalog(playlists, unlisted)
+
+    return get_catalog.catalog
+
+
+def add_playlist(spotify: spotipy.Spotify, playlist: Mapping):
+    """Add a newly created playlist to the memoized list of user playlists."""
+    get_catalog(spotify).add(select_fields([playlist], fields=PLAYLIST_FIELDS)[0])
 
 
-def get_playlists(spotify: spotipy.Spotify, reload=False) -> List[Dict[str, str]]:
-    """Get a list of user playlist names and ids. Memoized."""
-    if "playlists" not in get_playlists.__dict__ or reload:
-        playlists = get_all(spotify, spotify.current_user_playlists())
-        get_playlists.playlists = select_fields(playlists, fields=PLAYLIST_FIELDS)
+class PlaylistCatalog:
+    """Maintain the user playlists indexed by name and id.
+
+    Playlists outside the user's list, such as those of other users which are not followed, are
+    added by resolve without being listed.
+    """
+
+    def __init__(
+        self,
+        playlists: List[Dict[str, str]],
+        unlisted: Iterable[Dict[str, str]] = (),
+    ):
+        self.playlists = playlists  # Playlists listed for the user
+        self.unlisted = []  # Playlists resolved outside the user's list
+        self.lock = threading.Lock()  # Held while adding and saving resolved playlists
+        self.by_name = {}
+        self.by_id = {}
+        for playlist in playlists:
+            self._index(playlist, listed=True)
+        for playlist in unlisted:
+            self.add(playlist, listed=False)
+
+    def __contains__(self, playlist_id: str):
+        return playlist_id in self.by_id
+
+    def _index(self, playlist: Dict[str, str], listed: bool):
+        if listed:  # Only the user's playlists are found by name
+            self.by_name[playlist["name"]] = playlist["id"]
+        self.by_id[playlist["id"]] = playlist
+
+    def add(self, playlist: Dict[str, str], listed: bool = True):
+        """Add a playlist, listing it with the user playlists if listed, else only by id."""
+        if listed:
+            self.playlists.append(playlist)
+        else:
+            self.unlisted.append(playlist)
+        self._index(playlist, listed)
 
-    return get_playlists.playlists
+    def find_id(self, name: str) -> Optional[str]:
+        """Get the id of the last user playlist with the given name, or None if there is none."""
+        return self.by_name.get(name)
 
+    def find(self, playlist_id: str) -> Optional[Dict[str, str]]:
+        """Get the id, name and snapshot id of a playlist, or None if it is unknown."""
+        return self.by_id.get(playlist_id)
 
-def get_all(spotify: spotipy.Spotify, results: dict):
-    """Grab more results until none remain."""
-    items = results["items"]
-    while results["next"]:
-        results = spotify.next(results)
-        items.extend(results["items"])
+    def resolve(
+        self,
+        spotify: spotipy.Spotify,
+        playlist_ids: Iterable[str],
+        workers=None,
+        cached: Optional[bool] = None,
+    ):
+        """Look up playlists which are unknown or have no current snapshot id.
+
+        Up to workers (default PAGE_WORKERS) playlists are requested at once, each for only the
+        PLAYLIST_FIELDS. Playlists outside the user's list are saved for cached catalogs.
+        :param cached: keep the saved playlists instead, requesting nothing. Defaults to DRY_RUN
+        """
+        cached = DRY_RUN if cached is None else cached
+        if cached:
+            return
+        playlist_ids = [
+            playlist_id
+            for playlist_id in dict.fromkeys(playlist_ids)
+            if playlist_id and not self.by_id.get(playlist_id, {}).get("snapshot_id")
+        ]
+        if not playlist_ids:
+            return
+
+        fields = ",".join(path[0] for path in PLAYLIST_FIELDS.values())
+        workers = PAGE_WORKERS if workers is None else workers
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            results = list(
+                executor.map(
+                    lambda playlist_id: spotify.playlist(playlist_id, fields=fields),
+                    playlist_ids,
+                )
+            )
+        with self.lock:
+            for playlist in select_fields(results, fields=PLAYLIST_FIELDS):
+                known = self.by_id.get(playlist["id"])
+                if known is not None:
+                    known.update(playlist)
+                else:
+                    self.add(playlist, listed=False)
+            save_json(self.unlisted, "playlists_unlisted")
 
+
+def get_all(spotify: spotipy.Spotify, results: dict, workers: Optional[int] = None):
+    """Grab more results until none remain.
+
+    Pages after the first are requested by offset, up to workers (default PAGE_WORKERS) at once,
+    and reassembled in order.
+    """
+    items = []
+    for page in iter_pages(spotify, results, workers):
+        items.extend(page["items"])
     return items
 
 
+def iter_pages(
+    spotify: spotipy.Spotify, results: dict, workers: Optional[int] = None
+) -> Iterator[dict]:
+    """Yield every page of results in order, starting with results. See get_all.
+
+    No more than workers pages are requested ahead of the page being yielded.
+    """
+    yield results
+    urls = page_urls(results)
+    if urls is None:
+        while results["next"]:
+            results = spotify.next(results)
+            yield results
+        return
+
+    workers = max(1, PAGE_WORKERS if workers is None else workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for url in urls:
+            pending.append(executor.submit(spotify.next, {"next": url}))
+            if len(pending) >= workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def page_urls(results: dict) -> Optional[List[str]]:
+    """Get the urls of all pages following a page of results, or None if they cannot be derived."""
+    if not results["next"]:
+        return []
+    if not all(key in results for key in ("total", "limit", "offset")):
+        return None
+
+    url = urlsplit(results["next"])
+    query = parse_qs(url.query, keep_blank_values=True)
+    urls = []
+    limit = results["limit"]
+    for offset in range(results["offset"] + limit, results["total"], limit):
+        query["offset"] = [str(offset)]
+        urls.append(urlunsplit(url._replace(query=urlencode(query, doseq=True))))
+    return urls
+
+
 def get_credentials():
     """Load the credentials from the json."""
     with open(CREDS_FILE) as f:
@@ -456,17 +960,32 @@ def get_credentials():
 
 
 def get_spotify(s_creds):
-    """Get the spotify object from which to make requests."""
-    # Authorize Spotify
-    token = util.prompt_for_user_token(
-        s_creds["username"],
-        s_creds["scopes"],
-        s_creds["client_id"],
-        s_creds["client_secret"],
-        s_creds["redirect_uri"],
-    )
+    """Get the shared spotify object from which to make requests. Memoized per user."""
+    if "clients" not in get_spotify.__dict__:
+        get_spotify.clients = {}
+
+    username = s_creds["username"]
+    if username not in get_spotify.clients:
+        # Authorize Spotify, prompting the user if no token is cached yet
+        cache_path = ".cache-" + username
+        util.prompt_for_user_token(
+            username,
+            s_creds["scopes"],
+            s_creds["client_id"],
+            s_creds["client_secret"],
+            s_creds["redirect_uri"],
+            cache_path=cache_path,
+        )
+        auth_manager = spotipy.SpotifyOAuth(
+            s_creds["client_id"],
+            s_creds["client_secret"],
+            s_creds["redirect_uri"],
+            scope=s_creds["scopes"],
+            cache_path=cache_path,
+        )
+        get_spotify.clients[username] = SharedSpotify(auth_manager)
 
-    return spotipy.Spotify(auth=token)
+    return get_spotify.clients[username]
 
 
 def select_fields(
@@ -481,38 +1000,108 @@ def select_fields(
     :param fields: A dict of field names and the corresponding path (iterable) through a track dictionary to retrieve
                    the associated value.
     """
+    return list(iter_fields(items, root, fields))
 
-    if fields is None:
-        fields = TRACK_FIELDS
 
-    results = []
+def iter_fields(
+    items: Iterable[Mapping],
+    root: Optional[Iterable[str]] = None,
+    fields: Dict[str, Iterable[str]] = None,
+) -> Iterator[Dict]:
+    """Convert spotify api results to dicts as they are iterated. See select_fields."""
+    extract = compile_fields(TRACK_FIELDS if fields is None else fields)
+    root = tuple(root) if root else ()
     for item in items:
-        if root is not None:
-            for part in root:
-                item = item[part]
-        result = {}
-        for key, field in fields.items():
-            track = dict(item)
-            missing = False
-            for part in field:
+        for part in root:
+            item = item[part]
+        yield extract(item)
+
+
+def compile_fields(fields: Dict[str, Iterable[str]]) -> Callable[[Mapping], Dict]:
+    """Get a function which selects fields from an api result. Memoized.
+
+    Fields whose path is missing from a result are left out. Lists are converted to tuples.
+    """
+    if "compiled" not in compile_fields.__dict__:
+        compile_fields.compiled = {}
+
+    key = tuple((name, tuple(path)) for name, path in fields.items())
+    if key not in compile_fields.compiled:
+        getters = tuple((name, compile_path(path)) for name, path in key)
+
+        def extract(item: Mapping) -> Dict:
+            result = {}
+            for name, getter in getters:
                 try:
-                    track = track[part]
+                    value = getter(item)
                 except KeyError:
-                    missing = True
-                    break
-            if missing:
+                    continue
+                if isinstance(value, list):
+                    value = tuple(value)
+                result[name] = value
+            return result
+
+        compile_fields.compiled[key] = extract
+
+    return compile_fields.compiled[key]
+
+
+def compile_path(path: tuple) -> Callable[[Mapping], object]:
+    """Get a function which follows a path of keys and indices through an api result."""
+    if len(path) == 1:
+        (first,) = path
+        return lambda item: item[first]
+    if len(path) == 2:
+        first, second = path
+        return lambda item: item[first][second]
+    if len(path) == 3:
+        first, second, third = path
+        return lambda item: item[first][second][third]
+
+    def getter(item):
+        for part in path:
+            item = item[part]
+        return item
+
+    return getter
+
+
+def fields_projection(
+    fields: Mapping = TRACK_FIELDS, root=TRACK_ROOT, extra=PAGE_FIELDS
+) -> str:
+    """Get a Spotify fields parameter which returns only the given item fields and page fields.
+
+    e.g. items(track(name,artists(name))),next
+    """
+    tree = {}
+    for field in fields.values():
+        node = tree
+        for part in field:
+            if isinstance(part, int):  # Lists are filtered item by item
                 continue
-            if isinstance(track, list):
-                track = tuple(track)
-            result[key] = track
-        results.append(result)
-    return results
+            node = node.setdefault(part, {})
+    for part in reversed(root):
+        tree = {part: tree}
+
+    def format_tree(node):
+        """Format nested fields as a comma separated list."""
+        return ",".join(
+            key + (f"({format_tree(child)})" if child else "")
+            for key, child in node.items()
+        )
+
+    return ",".join([f"items({format_tree(tree)})", *extra])
 
 
 def results_to_tracks(results: dict, root=TRACK_ROOT) -> List[Track]:
     """Convert spotify api result dicts to tracks."""
-    dicts = select_fields(results, root)
-    return [Track(**d) for d in dicts]
+    return list(iter_tracks(results, root))
+
+
+def iter_tracks(results: Iterable[Mapping], root=TRACK_ROOT) -> Iterator[Track]:
+    """Convert spotify api result dicts to tracks as they are iterated."""
+    for fields in iter_fields(results, root):
+        yield Track(**fields)
 
 
 def remove_nonlocal(playlist: Playlist):
@@ -0,0 +1,254 @@
+"""Test playlists against the behaviour it must keep."""
+import json
+import random
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import chain
+from urllib.parse import urlsplit, parse_qs, urlencode
+
+import pytest
+import spotipy
+
+from playlists import Playlist, get_all, page_urls
+from utility import Track
+
+OPERATORS = ("+", "-", "&")
+ROUNDS = 300  # Random cases per operator and form
+PAGE_LATENCY = 0.02  # Most seconds the fake paging server waits before each page
+
+
+def old_add(own, other):
+    """Add tracks as Playlist did with lists."""
+    return list(chain(own, other))
+
+
+def old_sub(own, other):
+    """Remove tracks as Playlist did with lists."""
+    for track in other:
+        if track in own:
+            own.remove(track)
+    return own
+
+
+def old_intersect(own, other):
+    """Intersect tracks as Playlist did with lists."""
+    new = []
+    for track in other:
+        if track in own:
+            new.append(track)
+    own.clear()
+    own.extend(new)
+    return own
+
+
+OLD_OPERATIONS = {"+": old_add, "-": old_sub, "&": old_intersect}
+
+
+def old_membership_op(own, other, operator, allow_duplicates):
+    """Get the tracks Playlist gave for own operator other with lists."""
+    tracks = OLD_OPERATIONS[operator](list(own), list(other))
+    if not allow_duplicates:
+        tracks = list(OrderedDict.fromkeys(tracks))
+    return tracks
+
+
+def random_tracks(rng: random.Random, pool, size: int) -> list:
+    """Get a random multiset of tracks, with duplicates, from pool."""
+    return [rng.choice(pool) for _ in range(rng.randint(0, size))]
+
+
+def make_pool() -> list:
+    """Get tracks where some are equal but distinct objects, so identity shows which one is kept."""
+    pool = [Track(f"name {i}", "artist", "album", False, id=f"id{i}") for i in range(8)]
+    pool += [Track(f"name {i}", "artist", "album", False, id=f"id{i}") for i in range(4)]
+    return pool
+
+
+def make_playlist(tracks, allow_duplicates: bool) -> Playlist:
+    """Get an offline playlist holding tracks."""
+    playlist = Playlist(None, None, allow_duplicates=allow_duplicates)
+    playlist.tracks = list(tracks)
+    return playlist
+
+
+def apply(playlist: Playlist, operator: str, other, inplace: bool) -> Playlist:
+    """Apply a Playlist operator, in place if inplace."""
+    if inplace:
+        if operator == "+":
+            playlist += other
+        elif operator == "-":
+            playlist -= other
+        else:
+            playlist &= other
+        return playlist
+    if operator == "+":
+        return playlist + other
+    if operator == "-":
+        return playlist - other
+    return playlist & other
+
+
+@pytest.mark.parametrize("operator", OPERATORS)
+@pytest.mark.parametrize("inplace", (False, True))
+@pytest.mark.parametrize("allow_duplicates", (False, True))
+@pytest.mark.parametrize("other_type", ("playlist", "list", "iterator"))
+def test_operators_match_list_implementation(
+    operator, inplace, allow_duplicates, other_type
+):
+    rng = random.Random(f"{operator}{inplace}{allow_duplicates}{other_type}")
+    pool = make_pool()
+    for _ in range(ROUNDS):
+        own = random_tracks(rng, pool, 12)
+        other = random_tracks(rng, pool, 12)
+        expected = old_membership_op(own, other, operator, allow_duplicates)
+
+        playlist = make_playlist(own, allow_duplicates)
+        if other_type == "playlist":
+            operand = make_playlist(other, rng.random() < 0.5)
+        elif other_type == "list":
+            operand = list(other)
+        else:
+            operand = iter(other)
+        result = apply(playlist, operator, operand, inplace)
+
+        assert [id(track) for track in result.tracks] == [
+            id(track) for track in expected
+        ], (operator, own, other)
+        assert (result is playlist) == inplace
+        if not inplace:
+            assert playlist.tracks == own  # The left operand is untouched
+
+
+@pytest.mark.parametrize("operator", OPERATORS)
+def test_operators_accept_track(operator):
+    rng = random.Random(operator)
+    pool = make_pool()
+    for _ in range(ROUNDS):
+        own = random_tracks(rng, pool, 12)
+        track = rng.choice(pool)
+        for allow_duplicates in (False, True):
+            expected = old_membership_op(own, [track], operator, allow_duplicates)
+            playlist = make_playlist(own, allow_duplicates)
+            result = apply(playlist, operator, track, False)
+            assert [id(t) for t in result.tracks] == [id(t) for t in expected]
+
+
+class PagingServer(ThreadingHTTPServer):
+    """Serve pages of numbered items like the Spotify API, slowly, counting concurrent requests.
+
+    :param paged: whether pages include total, limit and offset, so following pages can be derived
+    """
+
+    daemon_threads = True
+
+    def __init__(self, total: int, paged: bool = True):
+        super().__init__(("127.0.0.1", 0), PagingHandler)
+        self.total = total
+        self.paged = paged
+        self.requests = 0
+        self.active = 0
+        self.most_active = 0
+        self.lock = threading.Lock()
+        self.rng = random.Random(total)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}/items"
+
+    def page(self, offset: int, limit: int, query: dict) -> dict:
+        """Get the page of items starting at offset."""
+        items = list(range(offset, min(offset + limit, self.total)))
+        next_url = None
+        if offset + limit < self.total:
+            query = dict(query, offset=offset + limit, limit=limit)
+            next_url = f"{self.url}?{urlencode(query)}"
+        page = {"items": items, "next": next_url}
+        if self.paged:
+            page.update(total=self.total, limit=limit, offset=offset)
+        return page
+
+
+class PagingHandler(BaseHTTPRequestHandler):
+    """Handle a page request to a PagingServer."""
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            server.active += 1
+            server.most_active = max(server.most_active, server.active)
+            latency = server.rng.uniform(0, PAGE_LATENCY)  # Pages finish out of order
+        time.sleep(latency)
+        query = {key: value[0] for key, value in parse_qs(urlsplit(self.path).query).items()}
+        offset = int(query.pop("offset", 0))
+        limit = int(query.pop("limit", 20))
+        body = json.dumps(server.page(offset, limit, query)).encode()
+        with server.lock:
+            server.active -= 1
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def paging_server(request):
+    """Start a PagingServer with the parameters of the test."""
+    server = PagingServer(*request.param)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def first_page(spotify: spotipy.Spotify, server: PagingServer, limit: int) -> dict:
+    """Get the first page of a PagingServer, as a Spotify endpoint would return it."""
+    return spotify.next({"next": f"{server.url}?market=US&offset=0&limit={limit}"})
+
+
+@pytest.mark.parametrize("paging_server", [(1234,)], indirect=True)
+@pytest.mark.parametrize("workers", (1, 3, 8))
+def test_get_all_reassembles_pages_in_order(paging_server, workers):
+    spotify = spotipy.Spotify(auth="token")
+    items = get_all(spotify, first_page(spotify, paging_server, 50), workers=workers)
+
+    assert items == list(range(1234))
+    assert paging_server.requests == 25
+    assert paging_server.most_active <= workers
+    if workers > 1:
+        assert paging_server.most_active > 1
+
+
+@pytest.mark.parametrize("paging_server", [(250, False)], indirect=True)
+def test_get_all_follows_next_without_page_counts(paging_server):
+    spotify = spotipy.Spotify(auth="token")
+    items = get_all(spotify, first_page(spotify, paging_server, 20), workers=8)
+
+    assert items == list(range(250))
+    assert paging_server.requests == 13
+    assert paging_server.most_active == 1
+
+
+def test_page_urls_keep_query():
+    results = {
+        "next": "https://api.spotify.com/v1/me/tracks?offset=50&limit=50&market=US",
+        "total": 180,
+        "limit": 50,
+        "offset": 0,
+    }
+    urls = page_urls(results)
+
+    assert [parse_qs(urlsplit(url).query) for url in urls] == [
+        {"offset": [str(offset)], "limit": ["50"], "market": ["US"]}
+        for offset in (50, 100, 150)
+    ]
+    assert page_urls(dict(results, next=None)) == []
+    assert page_urls({"next": results["next"]}) is None
@@ -1,6 +1,10 @@
+import heapq
 import re
 import string
-from collections import OrderedDict, namedtuple
+import sys
+import weakref
+from collections import OrderedDict, namedtuple, Counter, defaultdict
+from functools import lru_cache
 from itertools import groupby
 from typing import Union, Iterable
 
@@ -10,6 +14,13 @@ from unidecode import unidecode
 
 MINIMUM_SCORES = {"artist": 0.8, "name": 0.7, "album": 0}
 MINIMUM_SCORE = 1
+CLEAN_CHARS = frozenset(string.ascii_letters + string.digits + " ")
+CLEAN_CACHE_SIZE = 2 ** 16  # Number of ad-hoc strings to keep cleaned
+CLEANED_FIELDS = ("name", "artist", "album")  # Fields normalized on each Track
+INDEX_FIELDS = ("name", "artist")  # Cleaned fields to index by trigram
+INDEX_CANDIDATES = 50  # Number of best trigram candidates to score per lookup
+INDEX_STOP_FRACTION = 0.01  # Ignore trigrams shared by more of the library than this
+INDEX_CACHE_SIZE = 8  # Number of libraries to keep indexed
 
 TRACK_FIELDS = OrderedDict(
     name=("name",),
@@ -25,51 +36,101 @@ TRACK_FIELDS = OrderedDict(
 TRACK_ROOT = ("track",)
 
 
+def remove_extra(name):
+    """Remove the parentheses and hyphens from a song name."""
+    return re.sub(r"-[\S\s]*", "", re.sub(r"\([\w\W]*\)", "", name))
+
+
+def intern_string(value):
+    """Intern value if it is a string so repeated artists and albums share memory."""
+    if isinstance(value, str):
+        return sys.intern(value)
+    return value
+
+
+def share_markets(markets):
+    """Get a shared copy of a market list. Most tracks are available in the same markets."""
+    if not markets:
+        return markets
+    markets = tuple(markets)
+    return share_markets.shared.setdefault(markets, markets)
+
+
+share_markets.shared = {}
+
+
+@lru_cache(maxsize=CLEAN_CACHE_SIZE)
+def clean(name):
+    """Remove potential discrepencies from the string. Memoized."""
+    name = unidecode(name)  # Remove diacritics
+    name = "".join((c for c in name if c in CLEAN_CHARS))
+    name = name.lower().strip()
+    return name
+
+
 class Track:
-    """Maintain fields related to a single track in a playlist."""
+    """Maintain fields related to a single track in a playlist.
+
+    Tracks are identified by their keys fields, which must not change after creation.
+    """
 
     keys = ("name", "artist", "album", "is_local")
+    __slots__ = tuple(TRACK_FIELDS.keys()) + ("original_id", "cleaned", "_key", "_hash")
 
     def __init__(self, *args, **kwargs):
-        # Hardcode attributes so intellisense doesn't go mad
-        self.name = None
-        self.artist = None
-        self.album = None
-        self.id = None
-        self.is_local = None
-        self.duration_ms = None
-        self.available_markets = None
-        self.linked_from = None
+        fields = dict(zip(TRACK_FIELDS.keys(), args))
+        fields.update(kwargs)
+        self.name = fields.get("name")
+        self.artist = intern_string(fields.get("artist"))
+        self.album = intern_string(fields.get("album"))
+        self.is_local = fields.get("is_local")
+        self.id = fields.get("id")
+        self.duration_ms = fields.get("duration_ms")
+        self.available_markets = share_markets(fields.get("available_markets"))
+        self.linked_from = fields.get("linked_from")
+        self.is_playable = fields.get("is_playable")
         self.original_id = None
 
-        self.__dict__ = {key: None for key in TRACK_FIELDS.keys()}
-        self.__dict__.update(
-            {key: value for key, value in zip(TRACK_FIELDS.keys(), args)}
-        )
-        self.__dict__.update(kwargs)
-
         if self.linked_from:
             self.original_id = self.id
             self.id = self.linked_from
 
-        self.__slots__ = tuple(TRACK_FIELDS.keys())
+        # Normalized fields for fuzzy matching, computed once per track. Ordered as CLEANED_FIELDS
+        self.cleaned = tuple(
+            clean(getattr(self, key)) if getattr(self, key) else ""
+            for key in CLEANED_FIELDS
+        )
+
+        self._key = tuple(getattr(self, key) for key in self.__class__.keys)
+        self._hash = hash(self._key)
 
     def get_fields(self):
         """Get fields of this track for display."""
-        return {k: self.__dict__[k] for k in self.__class__.keys}
+        return {k: getattr(self, k) for k in self.__class__.keys}
+
+    def as_dict(self):
+        """Get the fields from which this track can be recreated."""
+        fields = {k: getattr(self, k) for k in TRACK_FIELDS.keys()}
+        if self.linked_from:
+            fields["id"] = self.original_id
+        return fields
 
     def __hash__(self):
-        return hash(tuple(self.get_fields().items()))
+        return self._hash
 
     def __repr__(self):
         return f"{self.__class__.__name__}({', '.join(f'{key}={repr(val)}' for key, val in self.get_fields().items())})"
 
     def __eq__(self, other):
-        return self.get_fields() == other.get_fields()
+        if self is other:
+            return True
+        if not isinstance(other, Track):
+            return NotImplemented
+        return self._hash == other._hash and self._key == other._key
 
     def copy(self):
         """Return a shallow copy of this track."""
-        return Track(**self.__dict__)
+        return Track(**self.as_dict())
 
 
 # Tracks which appear to be matches but are actually different
@@ -103,27 +164,60 @@ MATCH_ALBUM_EXCEPTIONS = (
 )
 
 
-def remove_extra(name):
-    """Remove the parentheses and hyphens from a song name."""
-    return re.sub(r"-[\S\s]*", "", re.sub(r"\([\w\W]*\)", "", name))
+def distance(str1, str2):
+    """Return the inverse of the Needleman-Wunsch similarity between two strings.
 
+    Closer to 1 is a better match.
+    """
+    return cleaned_distance(clean(str1), clean(str2))
 
-def clean(name):
-    """Remove potential discrepencies from the string."""
-    name = unidecode(name)  # Remove diacritics
-    name = "".join(
-        (c for c in name if c in (string.ascii_letters + string.digits + " "))
-    )
-    name = name.lower().strip()
-    return name
 
+def cleaned_distance(str1, str2):
+    """Return the inverse of the Needleman-Wunsch similarity between two cleaned strings."""
+    return 1 - levenshtein.normalized_distance(str1, str2)
 
-def distance(str1, str2):
-    """Return the inverse of the Needleman-Wunsch similarity between two strings.
 
-    Closer to 1 is a better match.
+def bounded_distance(str1, str2, minimum):
+    """Return cleaned_distance between two cleaned strings or 0 if it is below minimum.
+
+    Cheap length and character count filters run first and the levenshtein table is only
+    filled in a band around the diagonal, stopping once no path can stay within the bound.
     """
-    return 1 - levenshtein.normalized_distance(clean(str1), clean(str2))
+    max_len = max(len(str1), len(str2))
+    if not max_len or str1 == str2:
+        return 1
+    # Largest edit distance which could still satisfy minimum. One extra edit of slack
+    # guards against float rounding; the exact score is compared at the end.
+    bound = int((1 - minimum) * max_len) + 1
+
+    if abs(len(str1) - len(str2)) > bound:
+        return 0
+    counts1, counts2 = Counter(str1), Counter(str2)
+    if max(sum((counts1 - counts2).values()), sum((counts2 - counts1).values())) > bound:
+        return 0
+
+    if len(str1) > len(str2):
+        str1, str2 = str2, str1
+    over = bound + 1  # Stand-in for any distance beyond the bound
+    previous = [j if j <= bound else over for j in range(len(str2) + 1)]
+    for i, char1 in enumerate(str1, 1):
+        current = [over] * (len(str2) + 1)
+        if i <= bound:
+            current[0] = i
+        for j in range(max(1, i - bound), min(len(str2), i + bound) + 1):
+            current[j] = min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (char1 != str2[j - 1]),
+            )
+        if min(current) > bound:
+            return 0
+        previous = current
+
+    score = 1 - previous[-1] / max_len
+    if score < minimum:
+        return 0
+    return score
 
 
 def search_list(
@@ -132,34 +226,46 @@ def search_list(
     """Search through search_tracks for matches resembling target_track.
 
     :param target_track: the track to fuzzy search for by name, album, and artist
-    :param search_tracks: list of tracks. groupby artist and then search
-    :param search_tracks_name: if provided, check if search_tracks is memoized by name and memoize groups if not
+    :param search_tracks: list of tracks, versioned collection of tracks (Playlist), or TrackIndex.
+                          groupby artist or query a (cached) index and then search
+    :param search_tracks_name: if provided, name search_tracks in progress output
     """
-    if "grouped_lists" not in search_list.__dict__:
-        search_list.grouped_lists = {}
-
     suffix = ""
-    artist = target_track.artist.lower()
-    if artist:
-        # Check if memoized
-        if search_tracks_name and search_tracks_name in search_list.grouped_lists:
-            try:
-                suffix = f" in {search_tracks.name}"
-            except AttributeError:
-                suffix = f" in {search_tracks}"
-            grouped_list = search_list.grouped_lists[search_tracks_name]
-            if artist in grouped_list:
-                search_tracks = grouped_list[artist]
-            else:
-                search_tracks = []
-        else:
+    if search_tracks_name:
+        suffix = f" in {search_tracks_name}"
+    if INDEX_CACHE.accepts(search_tracks):
+        try:
+            suffix = f" in {search_tracks.name}"
+        except AttributeError:
+            pass
+        search_tracks = INDEX_CACHE.get(search_tracks)
+
+    fallback = ()
+    if isinstance(search_tracks, TrackIndex):
+        fallback = search_tracks.group(target_track)
+        search_tracks = search_tracks.candidates(target_track)
+    else:
+        artist = target_track.artist.lower()
+        if artist:
             groups = group_by_artist(search_tracks)
-            # Memoize
-            if search_tracks_name:
-                search_list.grouped_lists[search_tracks_name] = groups
             if artist in groups:
                 search_tracks = groups[artist]
 
+    desc = f"Searching for {target_track.name}" + suffix
+    matches = score_tracks(search_tracks, target_track, desc)
+    if not matches and len(fallback) > len(search_tracks):
+        # The best candidates of a large artist group missed, so score the rest of it
+        searched = set(search_tracks)
+        rest = [track for track in fallback if track not in searched]
+        matches = score_tracks(rest, target_track, desc)
+    return matches
+
+
+def score_tracks(search_tracks: Iterable, target_track, desc: str) -> list:
+    """Score search_tracks against target_track, stopping early at a perfect match.
+
+    :returns: (score, track) of each match, best first
+    """
     album_exceptions = []
     for exception_group in MATCH_ALBUM_EXCEPTIONS:
         if (
@@ -174,9 +280,7 @@ def search_list(
             track_exceptions = list(exception_group)
             track_exceptions.remove(target_track)
     matches = []
-    for track in tqdm(
-        search_tracks, desc=f"Searching for {target_track.name}" + suffix, leave=False
-    ):
+    for track in tqdm(search_tracks, desc=desc, leave=False):
         # Is automatically not a match for anything in track_exceptions or album exceptions
         if track in track_exceptions:
             continue
@@ -185,10 +289,16 @@ def search_list(
         good = True
         scores = []
         for score_name in MINIMUM_SCORES:
+            if not MINIMUM_SCORES[score_name]:
+                # Unweighted fields can neither reject nor add to a match
+                continue
             score = 0
-            if target_track.__dict__[score_name] and track.__dict__[score_name]:
-                score = distance(
-                    target_track.__dict__[score_name], track.__dict__[score_name]
+            if getattr(target_track, score_name) and getattr(track, score_name):
+                field = CLEANED_FIELDS.index(score_name)
+                score = bounded_distance(
+                    target_track.cleaned[field],
+                    track.cleaned[field],
+                    MINIMUM_SCORES[score_name],
                 )
             if score < MINIMUM_SCORES[score_name]:
                 good = False
@@ -211,8 +321,9 @@ def find_match(
     """Search through search_tracks for closest match to target_track.
 
     :param target_track: the track to fuzzy search for by name, album, and artist
-    :param search_tracks: list of tracks. groupby artist and then search
-    :param search_tracks_name: if provided, check if search_tracks is memoized by name and memoize groups if not
+    :param search_tracks: list of tracks, versioned collection of tracks (Playlist), or TrackIndex.
+                          groupby artist or query a (cached) index and then search
+    :param search_tracks_name: if provided, name search_tracks in progress output
     """
     matches = search_list(search_tracks, target_track, search_tracks_name)
 
@@ -225,6 +336,141 @@ def find_match(
     return None
 
 
+def trigrams(name):
+    """Get the set of character trigrams in a cleaned string."""
+    name = f" {name} "
+    return {name[i : i + 3] for i in range(len(name) - 2)}
+
+
+def name_trigrams(track):
+    """Get the trigrams of a track's cleaned name, tagged as in track_trigrams."""
+    name = track.cleaned[CLEANED_FIELDS.index("name")]
+    return {("name", gram) for gram in trigrams(name)}
+
+
+def track_trigrams(track):
+    """Get the trigrams of a track's indexed fields, tagged by field."""
+    return {
+        (field, gram)
+        for field in INDEX_FIELDS
+        for gram in trigrams(track.cleaned[CLEANED_FIELDS.index(field)])
+    }
+
+
+class TrackIndex:
+    """Maintain a trigram inverted index over a library of tracks for fuzzy lookups."""
+
+    def __init__(self, tracks: Iterable, candidates: int = INDEX_CANDIDATES):
+        self.tracks = tuple(tracks)
+        self.limit = candidates
+        self.artists = group_by_artist(self.tracks)
+        self.postings = defaultdict(list)
+        self.sizes = []  # Number of indexed trigrams of each track
+        for pos, track in enumerate(self.tracks):
+            grams = track_trigrams(track)
+            self.sizes.append(len(grams))
+            for gram in grams:
+                self.postings[gram].append(pos)
+        self.stop_size = max(candidates, int(len(self.tracks) * INDEX_STOP_FRACTION))
+
+        # Name trigram postings within each artist group too large to return whole
+        self.groups = {}
+        for pos, track in enumerate(self.tracks):
+            artist = (track.artist or "").lower()
+            if len(self.artists.get(artist, ())) > candidates:
+                group = self.groups.setdefault(artist, defaultdict(list))
+                for gram in name_trigrams(track):
+                    group[gram].append(pos)
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def __iter__(self):
+        return iter(self.tracks)
+
+    def group(self, target_track) -> tuple:
+        """Get the tracks by the same artist as target_track, or an empty tuple if none."""
+        return self.artists.get((target_track.artist or "").lower(), ())
+
+    def candidates(self, target_track, limit: int = None) -> list:
+        """Get the tracks most likely to match target_track.
+
+        Small groups by the same artist are returned whole, and large ones are ranked by the name
+        trigrams their tracks share with target_track. Without a group, the tracks sharing the most
+        name and artist trigrams are returned so other artist spellings are covered. Trigrams common
+        to a large part of the library are skipped unless nothing rarer is shared. Ties go to the
+        tracks with the fewest other trigrams, so exact matches always rank first.
+        """
+        limit = self.limit if limit is None else limit
+        group = self.group(target_track)
+        if group and len(group) <= limit:
+            return list(group)
+
+        artist = (target_track.artist or "").lower()
+        counts = Counter()
+        if artist in self.groups:
+            postings = self.groups[artist]
+            for gram in name_trigrams(target_track):
+                counts.update(postings.get(gram, ()))
+        else:
+            grams = track_trigrams(target_track)
+            postings = [self.postings[gram] for gram in grams if gram in self.postings]
+            rare = [
+                positions for positions in postings if len(positions) <= self.stop_size
+            ]
+            for positions in rare or postings:
+                counts.update(positions)
+        best = heapq.nsmallest(
+            limit, counts, key=lambda pos: (-counts[pos], self.sizes[pos], pos)
+        )
+        return [self.tracks[pos] for pos in best]
+
+
+class IndexCache:
+    """Maintain TrackIndexes for versioned track collections, evicting the least recently used.
+
+    Collections are keyed by identity and must have a version attribute which changes on every
+    mutation, so a stale index is rebuilt rather than reused.
+    """
+
+    def __init__(self, maxsize: int = INDEX_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()  # id -> (weakref to collection, version, index)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def accepts(tracks) -> bool:
+        """Determine whether an index for tracks can be cached."""
+        return hasattr(tracks, "version")
+
+    def get(self, tracks) -> TrackIndex:
+        """Get the index for the current version of tracks, building it if necessary."""
+        key = id(tracks)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0]() is tracks and entry[1] == tracks.version:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+        self.misses += 1
+        index = TrackIndex(tracks)
+        self.entries[key] = (weakref.ref(tracks), tracks.version, index)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return index
+
+    def clear(self):
+        """Remove all indexes and reset the counters."""
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+INDEX_CACHE = IndexCache()
+
+
 def group_by_artist(search_tracks):
     """Group a list of tracks by artist."""
     key = lambda t: t.artist